@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Offline end-to-end benchmark of HMParser/CosParser in parser or update mode.
+The sites, image hosts and upload endpoint are served by the local stand-in server (standin.py) from the
+fixtures with the given latency, the translator is stubbed and Mongo is replaced by memory_mongo.
+Caches, images, checkpoints and metrics of the run are kept in a temporary directory, so every run starts cold.
+The host limits of CONFIG.toml apply as in production: all images of a brand come from one host.
+Reports the throughput, the stand-in requests and the time of every pipeline stage.
+
+Update mode first seeds the collection with the products; --changed of them have a stale availability
+and are written, the others are found unchanged.
+
+Usage (from the repository root):
+    python benchmarks/bench_pipeline.py <hm|cos> <parser|update> [--products N] [--latency MS]
+                                        [--translate-latency MS] [--changed FRACTION]
+"""
+
+from contextlib import redirect_stdout
+import argparse
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from memory_mongo import Database
+from standin import StandInServer, StandInAdapter, StubTranslator, read_fixture
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BRANDS = {
+    'hm': ('HMParser', 'www2.hm.com', 'h&m'),
+    'cos': ('CosParser', 'www.cos.com', 'cos'),
+}
+STATUSES = (('fewPieceLeft', 'few_pieces_left'), ('availability', 'in_stock'))
+
+
+def load(brand):
+    # CONFIG.toml and the brand config files are read relative to the repository root
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    return importlib.import_module(f'{brand}_parser.{brand}_parser'), importlib.import_module(f'{brand}_parser.utils')
+
+
+def seed(collection, parser, module, site, brandName, changed):
+    """Inserts a stored document for every product of the site, a changed fraction with an outdated availability"""
+    fields = module.extractProduct(read_fixture(site.brand, 'product.html.gz'))
+    deliveryPrice = 3.0
+    price = parser.getPrice(fields['originalPrice'], deliveryPrice)
+
+    articles = site.articles()
+    for i, article in enumerate(articles):
+        statuses = {}
+        for key, status in STATUSES:
+            statuses.update(dict.fromkeys(site.availability_of(article)[key], status))
+        stale = int(i * changed) != int((i + 1) * changed)
+        colors = [{
+            'code': color['key'][-3:],
+            'sizes': [{'name': size['name'], 'code': size['code'],
+                       'availability': '' if stale else
+                       statuses.get(f"{article}{color['key'][-3:]}{size['code']}", 'out_of_stock')}
+                      for size in color['sizes']],
+        } for color in fields['colors']]
+        collection.insert_one({'article': article, 'brand': brandName, 'colors': colors, 'deliveryPrice': deliveryPrice,
+                               'originalPrice': fields['originalPrice'], 'price': price})
+
+
+def report(brand, mode, products, elapsed, server, utils, mark, collection):
+    print(f'{brand} {mode}: {products} products in {elapsed:.2f} s, {products / elapsed:.1f} products/s, '
+          f'{collection.count_documents({})} documents, {collection.bulk_writes} bulk writes')
+
+    print(f'\n{"stand-in":20} {"requests":>9} {"KiB":>9}')
+    for kind, (count, size) in sorted(server.requests.items()):
+        print(f'{kind:20} {count:9} {size / 1024:9.0f}')
+
+    summary = utils.METRICS.summary(mark)
+    print(f'\n{"stage":16} {"count":>7} {"seconds":>9} {"ms/product":>11} {"p50 ms":>8} {"p95 ms":>8}')
+    for stage, timing in sorted(summary['stages'].items(), key=lambda item: -item[1]['seconds']):
+        print(f'{stage:16} {timing["count"]:7} {timing["seconds"]:9.2f} {timing["seconds"] / products * 1000:11.1f} '
+              f'{timing["p50"] * 1000:8.1f} {timing["p95"] * 1000:8.1f}')
+    print()
+    for name, value in sorted(summary['counters'].items()):
+        print(f'{name}: {value}')
+
+
+def main(brand, mode, products, latency, translate_latency, changed):
+    module, utils = load(brand)
+    className, host, brandName = BRANDS[brand]
+
+    collection = Database()['tmp_Products']
+    category = next(iter(module.loadConfigFile('categories.json'))) if mode == 'parser' else None
+    parser = getattr(module, className)(category, mode, collection)
+    # the settings are cached by loadConfigFile, so the run itself can leave the repository root
+    if mode == 'parser':
+        parser.loadParserSettings()
+    else:
+        parser.loadUpdateSettings()
+
+    workdir = tempfile.mkdtemp(prefix='bench_pipeline_')
+    os.chdir(workdir)
+    StubTranslator.latency = translate_latency
+    utils.parser_utils.GoogleTranslator = StubTranslator # the translator is shared by the brands
+    try:
+        with StandInServer(products, latency) as server:
+            adapter = StandInAdapter(server.address)
+            utils.SESSION.mount('http://', adapter)
+            utils.SESSION.mount('https://', adapter)
+            module.initSession()
+            if mode == 'update':
+                seed(collection, parser, module, server.sites[host], brandName, changed)
+            server.requests.clear()
+
+            mark = utils.METRICS.mark()
+            start = time.perf_counter()
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                parser.parse()
+            elapsed = time.perf_counter() - start
+
+        report(brand, mode, products, elapsed, server, utils, mark, collection)
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser(description='Offline benchmark of the parser pipeline')
+    arguments.add_argument('brand', choices=BRANDS)
+    arguments.add_argument('mode', choices=('parser', 'update'))
+    arguments.add_argument('--products', type=int, default=100, help='products in the category (default 100)')
+    arguments.add_argument('--latency', type=float, default=50, help='stand-in response latency, ms (default 50)')
+    arguments.add_argument('--translate-latency', type=float, default=100,
+                           help='stub translator latency, ms (default 100)')
+    arguments.add_argument('--changed', type=float, default=0.2,
+                           help='update mode: fraction of products whose availability changed (default 0.2)')
+    args = arguments.parse_args()
+    main(args.brand, args.mode, args.products, args.latency / 1000, args.translate_latency / 1000, args.changed)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Benchmark of getProductDataFromJS against the previous regex-rewrite implementation.
+For COS the price formats the site shows are also compared with the previous slicing of the price text.
+
+Usage (from the repository root):
+    python benchmarks/bench_product_data.py <hm|cos> <saved product page.html> [...]
+"""
+
+import importlib
+import json
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ITERATIONS = 50
+
+
+def legacy_hm(html):
+    regexp = re.compile(r'var\s+productArticleDetails\s*=\s*(\{.*?\});', re.DOTALL)
+    output_str = re.search(regexp, html).group(1).replace("'", '"')
+    output_str = re.sub(r'"materials": \[([^\[\]]*)\],', '"materials": [""],', output_str)
+    output_str = re.sub(r'"url":[^\n]*', '"url": "",', output_str)
+    output_str = re.sub(r'"thumbnail":[^\n]*', '"thumbnail": "",', output_str)
+    output_str = re.sub(r'"image":\s*isDesktop\s*\?\s*"(.*)"\s*:\s*"(.*)"', r'"image": "\1"', output_str)
+    output_str = re.sub(r'"fullscreen":[^\n]*', '"fullscreen": "",', output_str)
+    output_str = re.sub(r'"recommendedDelivery":[^\n]*', '"recommendedDelivery": ""', output_str)
+    output_str = re.sub(r'"brandPagePath":[^\n]*', '"brandPagePath": ""', output_str)
+    output_str = re.sub(r'"zoom":[^\n]*', '"zoom": ""', output_str)
+    output_str = re.sub(r'"deliveryBulkyText":[^\n]*', ',"deliveryBulkyText": ""', output_str)
+    output_str = re.sub(r'"brandName": ([^\n]*),', '"brandName": ""', output_str)
+    return json.loads(output_str)
+
+
+def legacy_cos(html):
+    regexp = re.compile(r'var\s+productArticleDetails\s*=\s*(\{.*?\});', re.DOTALL)
+    output_str = re.search(regexp, html).group(1).replace("'", '"')
+    output_str = re.sub(r'"sizeName" : "(.*)",', r'"sizeName" : "\1"', output_str)
+    output_str = re.sub(r'"materials": \[([^\[\]]*)\],', '"materials": [""],', output_str)
+    output_str = re.sub(r'"url":[^\n]*', '"url": "",', output_str)
+    output_str = re.sub(r'"url": "",\s*}', '"url": ""}', output_str)
+    output_str = re.sub(r'"image":\s*isDesktop\s*\?\s*"(.*)"\s*:\s*"(.*)"', r'"image": "\1"', output_str)
+    output_str = re.sub(r'getPro"fullscreen":[^\n]*', '"fullscreen": "",', output_str)
+    output_str = re.sub(r'"recommendedDelivery":[^\n]*', '"recommendedDelivery": ""', output_str)
+    pattern = re.compile(r'"compositions": \[.*?\],', re.DOTALL)
+    output_str = re.sub(pattern, '"compositions": [],', output_str)
+    output_str = re.sub(r'"zoom":[^\n]*', '"zoom": ""', output_str)
+    return json.loads(output_str)
+
+
+def legacy_cos_price(text):
+    return float(text.strip()[2:].replace(',', '.'))
+
+
+COS_PRICES = ['€ 35,00', '€ 35.00', '€ 35', '€ 35,5']
+
+
+# fields of every colour the parsers read
+USED_FIELDS = {
+    'hm': lambda color: (color['name'], color['rgb'], [i['image'] for i in color['images']],
+                         [(s['name'], s['size']) for s in color['sizes']]),
+    'cos': lambda color: (color['name'], [i['thumbnail'] for i in color['vAssets']],
+                          [(s['sizeName'], s['sizeCode']) for s in color['variants']]),
+}
+
+
+def used_fields(brand, data):
+    return {key: USED_FIELDS[brand](value) for key, value in data.items() if re.match(r'[0-9]{10}', key)}
+
+
+def measure(function, html):
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        function(html)
+    return (time.perf_counter() - start) / ITERATIONS * 1000
+
+
+def main(brand, paths):
+    sys.path.insert(0, os.path.join(ROOT, f'{brand}_parser'))
+    module = importlib.import_module(f'{brand}_parser')
+    utils = importlib.import_module('utils')
+    parser_class = module.HMParser if brand == 'hm' else module.CosParser
+
+    legacy = legacy_hm if brand == 'hm' else legacy_cos
+    current = lambda html: parser_class.getProductDataFromJS(None, html)
+    tokenizer = lambda html: utils.parse_js_object(html, module.PRODUCT_DATA_REGEXP.search(html).end())[0]
+
+    print(f'{"page":40} {"legacy ms":>10} {"current ms":>10} {"tokenizer ms":>12}  same fields')
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            html = f.read()
+
+        expected = used_fields(brand, legacy(html))
+        same = used_fields(brand, current(html)) == expected and used_fields(brand, tokenizer(html)) == expected
+        if brand == 'cos':
+            prices = COS_PRICES + [module.PRICE_XPATH(module.lxml.html.document_fromstring(html))[0].text_content()]
+            same = same and all(module.parsePrice(price) == legacy_cos_price(price) for price in prices)
+        print(f'{os.path.basename(path):40} {measure(legacy, html):10.3f} {measure(current, html):10.3f} '
+              f'{measure(tokenizer, html):12.3f}  {same}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ('hm', 'cos'):
+        print(f"Usage: {sys.argv[0]} <hm|cos> <page.html> [...]")
+        sys.exit()
+    main(sys.argv[1], sys.argv[2:])
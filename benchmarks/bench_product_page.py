@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Benchmark of product page field extraction: BeautifulSoup tree vs lxml with precompiled XPath.
+Peak RSS growth while holding RSS_TREES parsed trees is measured in a fresh interpreter
+(not available on Windows).
+
+Usage (from the repository root):
+    python benchmarks/bench_product_page.py <hm|cos> <saved product page.html> [...]
+"""
+
+import importlib
+import os
+import subprocess
+import sys
+import time
+
+from bs4 import BeautifulSoup
+from lxml import etree
+import lxml.html
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ITERATIONS = 20
+RSS_TREES = 10
+
+
+def soup_hm(html, module):
+    soup = BeautifulSoup(html, 'lxml')
+    brand = soup.select_one('#js-product-name h2')
+    return (brand.text if brand else None, soup.h1.text, soup.find('span', class_='price-value').text,
+            soup.find('div', id='section-descriptionAccordion').find('p').text,
+            soup.find('div', id='section-materialsAndSuppliersAccordion').find('p').text)
+
+
+def lxml_hm(html, module):
+    tree = lxml.html.document_fromstring(html)
+    brand = module.BRAND_XPATH(tree)
+    return (brand[0].text_content() if brand else None, module.NAME_XPATH(tree)[0].text_content(),
+            module.PRICE_XPATH(tree)[0].text_content(), module.DESCRIPTION_XPATH(tree)[0].text_content(),
+            module.MATERIAL_XPATH(tree)[0].text_content())
+
+
+def soup_cos(html, module):
+    soup = BeautifulSoup(html, 'lxml')
+    return (soup.find('span', {'class': 'productPrice'}).text, str(soup.find('div', {'id': 'description'})))
+
+
+def lxml_cos(html, module):
+    tree = lxml.html.document_fromstring(html)
+    return (module.PRICE_XPATH(tree)[0].text_content(),
+            etree.tostring(module.DESCRIPTION_XPATH(tree)[0], encoding='unicode', method='html', with_tail=False))
+
+
+METHODS = {
+    'hm': {'soup': soup_hm, 'lxml': lxml_hm},
+    'cos': {'soup': soup_cos, 'lxml': lxml_cos},
+}
+
+
+def load(brand):
+    sys.path.insert(0, os.path.join(ROOT, f'{brand}_parser'))
+    return importlib.import_module(f'{brand}_parser')
+
+
+def measure(function, html, module):
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        function(html, module)
+    return (time.perf_counter() - start) / ITERATIONS * 1000
+
+
+def peak_rss(method, path):
+    if resource is None:
+        return None
+    output = subprocess.run([sys.executable, __file__, '--rss', method, path],
+                            capture_output=True, text=True, cwd=ROOT).stdout
+    return int(output) if output.strip() else None
+
+
+def print_rss(method, path):
+    with open(path, 'r', encoding='utf-8') as f:
+        html = f.read()
+    parse = (lambda: BeautifulSoup(html, 'lxml')) if method == 'soup' else (lambda: lxml.html.document_fromstring(html))
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    trees = [parse() for _ in range(RSS_TREES)]
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+
+
+def main(brand, paths):
+    # a child inherits the parent's peak RSS on Linux, so measure memory before imports and timing runs grow it
+    rss = {path: (peak_rss('soup', path), peak_rss('lxml', path)) for path in paths}
+
+    module = load(brand)
+    soup, lean = METHODS[brand]['soup'], METHODS[brand]['lxml']
+
+    print(f'{"page":30} {"soup ms":>9} {"lxml ms":>9} {"soup RSS KiB":>13} {"lxml RSS KiB":>13}')
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            html = f.read()
+        print(f'{os.path.basename(path):30} {measure(soup, html, module):9.2f} {measure(lean, html, module):9.2f} '
+              f'{str(rss[path][0]):>13} {str(rss[path][1]):>13}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--rss':
+        print_rss(*sys.argv[2:])
+    elif len(sys.argv) >= 3 and sys.argv[1] in METHODS:
+        main(sys.argv[1], sys.argv[2:])
+    else:
+        print(f"Usage: {sys.argv[0]} <hm|cos> <page.html> [...]")
@@ -0,0 +1,194 @@
+"""
+In-memory stand-in for the part of the pymongo Database/Collection API the parsers use:
+find/find_one with projection, sort, skip and limit, count_documents, find_one_and_update,
+insert_many, update_one, delete_many, bulk_write of InsertOne/UpdateOne and create_index.
+Filters support equality, $in, $gt, $gte, $lt and $or; updates support $set with dotted paths.
+"""
+
+import copy
+import threading
+
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+
+def matches(document, filter_criteria):
+    for key, condition in filter_criteria.items():
+        if key == '$or':
+            if not any(matches(document, alternative) for alternative in condition):
+                return False
+            continue
+        value = document.get(key)
+        if isinstance(condition, dict) and any(op.startswith('$') for op in condition):
+            for op, argument in condition.items():
+                if op == '$in' and value not in argument:
+                    return False
+                if op in ('$gt', '$gte', '$lt') and value is None:
+                    return False
+                if (op == '$gt' and not value > argument or op == '$gte' and not value >= argument
+                        or op == '$lt' and not value < argument):
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def set_path(document, path, value):
+    *parents, last = path.split('.')
+    for part in parents:
+        document = document[int(part)] if isinstance(document, list) else document[part]
+    if isinstance(document, list):
+        document[int(last)] = value
+    else:
+        document[last] = value
+
+
+def project(document, projection):
+    if not projection:
+        return copy.deepcopy(document)
+    result = {key: copy.deepcopy(document[key]) for key, include in projection.items()
+              if include and key != '_id' and key in document}
+    if projection.get('_id', True):
+        result['_id'] = document['_id']
+    return result
+
+
+class Result:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+class Cursor:
+    def __init__(self, documents):
+        self.documents = documents
+        self._skip = 0
+        self._limit = 0
+        self._iterator = None
+
+    def sort(self, key, direction=1):
+        self.documents.sort(key=lambda document: document.get(key) or '', reverse=direction == -1)
+        return self
+
+    def skip(self, count):
+        self._skip = count
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._iterator is None:
+            documents = self.documents[self._skip:]
+            self._iterator = iter(documents[:self._limit] if self._limit else documents)
+        return next(self._iterator)
+
+    def close(self):
+        pass
+
+
+class Collection:
+    def __init__(self, database=None):
+        self.database = database
+        self.documents = []
+        self.by_article = {} # article -> documents, filters on an article do not scan the collection
+        self.bulk_writes = 0
+        self._lock = threading.RLock()
+
+    def create_index(self, keys, **kwargs):
+        pass
+
+    def count_documents(self, filter_criteria):
+        with self._lock:
+            return sum(matches(document, filter_criteria) for document in self.documents)
+
+    def candidates(self, filter_criteria):
+        article = filter_criteria.get('article')
+        if isinstance(article, str):
+            return self.by_article.get(article, [])
+        return self.documents
+
+    def find(self, filter_criteria=None, projection=None):
+        with self._lock:
+            return Cursor([project(document, projection) for document in self.candidates(filter_criteria or {})
+                           if matches(document, filter_criteria or {})])
+
+    def find_one(self, filter_criteria=None, projection=None):
+        return next(self.find(filter_criteria, projection), None)
+
+    def insert_one(self, document):
+        with self._lock:
+            document.setdefault('_id', ObjectId())
+            stored = copy.deepcopy(document)
+            self.documents.append(stored)
+            if 'article' in stored:
+                self.by_article.setdefault(stored['article'], []).append(stored)
+            return Result(inserted_id=document['_id'])
+
+    def insert_many(self, documents, ordered=True):
+        with self._lock:
+            ids = {document['_id'] for document in self.documents}
+            for i, document in enumerate(documents):
+                if document.get('_id') in ids:
+                    raise BulkWriteError({'writeErrors': [{'index': i, 'errmsg': 'E11000 duplicate key error'}],
+                                          'nInserted': i, 'nModified': 0})
+                self.insert_one(document)
+
+    def update_one(self, filter_criteria, update, upsert=False):
+        with self._lock:
+            for document in self.candidates(filter_criteria):
+                if matches(document, filter_criteria):
+                    for path, value in update.get('$set', {}).items():
+                        set_path(document, path, value)
+                    return Result(matched_count=1, modified_count=1)
+            if upsert:
+                document = {key: value for key, value in filter_criteria.items() if not isinstance(value, dict)}
+                document.update(update.get('$set', {}))
+                self.insert_one(document)
+            return Result(matched_count=0, modified_count=0)
+
+    def delete_many(self, filter_criteria):
+        with self._lock:
+            self.documents = [document for document in self.documents if not matches(document, filter_criteria)]
+            self.by_article = {}
+            for document in self.documents:
+                if 'article' in document:
+                    self.by_article.setdefault(document['article'], []).append(document)
+
+    def find_one_and_update(self, filter_criteria, update, sort=None, return_document=None, **kwargs):
+        with self._lock:
+            documents = [document for document in self.documents if matches(document, filter_criteria)]
+            for key, direction in reversed(sort or []):
+                documents.sort(key=lambda document: document.get(key), reverse=direction == -1)
+            if not documents:
+                return None
+            for path, value in update.get('$set', {}).items():
+                set_path(documents[0], path, value)
+            return copy.deepcopy(documents[0])
+
+    def bulk_write(self, requests, ordered=True):
+        inserted = modified = 0
+        with self._lock:
+            self.bulk_writes += 1
+            for request in requests:
+                # the operation objects keep their arguments in private fields
+                if isinstance(request, InsertOne):
+                    self.insert_one(request._doc)
+                    inserted += 1
+                elif isinstance(request, UpdateOne):
+                    modified += self.update_one(request._filter, request._doc, upsert=bool(request._upsert)).modified_count
+        return Result(inserted_count=inserted, modified_count=modified)
+
+
+class Database:
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = Collection(self)
+        return self.collections[name]
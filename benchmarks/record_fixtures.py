@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Records the fixtures of bench_pipeline.py from the live site: the product page, its availability JSON
+and the first image of the product are saved to benchmarks/fixtures over the current ones.
+The listing and tile templates are kept, the stand-in server renders listings of any size from them.
+
+Usage (from the repository root):
+    python benchmarks/record_fixtures.py <hm|cos> <product page URL>
+"""
+
+import gzip
+import importlib
+import json
+import os
+import re
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'benchmarks', 'fixtures')
+AVAILABILITY_URLS = {
+    'hm': 'https://www2.hm.com/hmwebservices/service/product/pl/availability/{}.json',
+    'cos': 'https://www.cos.com/webservices_cos/service/product/cos-europe/availability/{}.json',
+}
+
+
+def fetch(utils, url):
+    response = utils.make_request(url)
+    if response is None:
+        sys.exit(f'Error: cannot fetch {url}')
+    return response
+
+
+def main(brand, url):
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    module = importlib.import_module(f'{brand}_parser.{brand}_parser')
+    utils = importlib.import_module(f'{brand}_parser.utils')
+    module.initSession()
+
+    html = fetch(utils, url).text
+    article = re.search(r'[0-9]{10}', url).group(0)[:7]
+    availability = fetch(utils, AVAILABILITY_URLS[brand].format(article)).json()
+    image = fetch(utils, module.extractProduct(html)['colors'][0]['images'][0]).content
+
+    with gzip.open(os.path.join(FIXTURES, brand, 'product.html.gz'), 'wt', encoding='utf-8') as f:
+        f.write(html)
+    with open(os.path.join(FIXTURES, brand, 'availability.json'), 'w', encoding='utf-8') as f:
+        json.dump({key: availability[key] for key in ('availability', 'fewPieceLeft')}, f, indent=4)
+    with open(os.path.join(FIXTURES, 'image.jpg'), 'wb') as f:
+        f.write(image)
+    print('Recorded', article, 'to', FIXTURES)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] not in AVAILABILITY_URLS:
+        print(f"Usage: {sys.argv[0]} <hm|cos> <product page URL>")
+        sys.exit()
+    main(sys.argv[1], sys.argv[2])
@@ -0,0 +1,197 @@
+"""
+Local stand-in for the H&M/COS sites, their image hosts, the translator and the upload endpoint.
+Pages are rendered from the fixtures in benchmarks/fixtures: a category listing of any number of products
+(paginated like the live H&M listing),
+product pages and availability JSON with the fixture article replaced by the requested one, and one image.
+Every request waits latency seconds before it is answered.
+
+StandInAdapter mounted on a requests session sends all its requests to the server,
+the host the request was meant for is passed in the X-Original-Host header.
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, urlunsplit, parse_qs
+import gzip
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+import requests
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+FIRST_ARTICLE = 1000000
+LISTING_PAGE_SIZES = {'hm': 36} # the COS listing shows the whole category on one page
+
+
+def read_fixture(*path):
+    path = os.path.join(FIXTURES, *path)
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        return f.read()
+
+
+class Site:
+    """Pages of one brand rendered from its fixtures"""
+    def __init__(self, brand, host, product_count):
+        self.brand = brand
+        self.host = host
+        self.product_count = product_count
+        self.product = read_fixture(brand, 'product.html.gz')
+        self.availability = read_fixture(brand, 'availability.json')
+        self.listing = read_fixture(brand, 'listing.html')
+        self.tile = read_fixture(brand, 'tile.html')
+        self.page_size = LISTING_PAGE_SIZES.get(brand)
+        # the 7 digit article of the recorded page, replaced by the requested one
+        self.article = re.search(r'"([0-9]{10})"\s*:\s*\{', self.product).group(1)[:7]
+
+    def articles(self):
+        return [f'{FIRST_ARTICLE + i:07d}' for i in range(self.product_count)]
+
+    def product_url(self, article):
+        if self.brand == 'hm':
+            return f'https://{self.host}/pl_pl/productpage.{article}001.html'
+        return f'https://{self.host}/en_eur/women/t-shirts/product.t-shirt-{article}.{article}001.html'
+
+    def availability_of(self, article):
+        """Parsed availability JSON of article"""
+        return json.loads(self.availability.replace(self.article, article))
+
+    def get(self, path, query):
+        """Returns (content type, body) or None for an unknown path"""
+        match = re.search(r'/availability/([0-9]{7})\.json$', path)
+        if match:
+            return 'application/json', self.availability.replace(self.article, match.group(1))
+        match = re.search(r'\.([0-9]{7})[0-9]{3}\.html$', path)
+        if match:
+            return 'text/html; charset=utf-8', self.product.replace(self.article, match.group(1))
+        if path in ('', '/'):
+            return 'text/html; charset=utf-8', '<html><body></body></html>'
+        if path.endswith('.html'):
+            return 'text/html; charset=utf-8', self.listing_page(query)
+        return None
+
+    def listing_page(self, query):
+        articles = self.articles()
+        pagination = ''
+        if self.page_size:
+            # the H&M listing shows page_size products per page whatever page-size asks for,
+            # a page is addressed by its number (linked from the pagination) or by offset
+            if 'page' in query:
+                offset = (int(query['page'][0]) - 1) * self.page_size
+            else:
+                offset = int(query.get('offset', ['0'])[0])
+            articles = articles[offset:offset + self.page_size]
+            pages = -(-self.product_count // self.page_size)
+            pagination = ''.join(f'<a href="?page={page}">{page}</a>' for page in range(1, pages + 1))
+        tiles = ''.join(self.tile.replace('{url}', self.product_url(article)).replace('{article}', article)
+                        for article in articles)
+        return (self.listing.replace('{tiles}', tiles).replace('{total}', str(self.product_count))
+                .replace('{shown}', str(len(articles))).replace('{pagination}', pagination))
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # streamed product pages are closed as soon as the price has been read
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+class StandInServer:
+    """
+    HTTP server answering for every host: brand sites by X-Original-Host, any other GET with the image fixture
+    and any POST (photo upload) with 'success'. Counts requests and bytes per kind.
+    """
+    def __init__(self, product_count, latency=0.05):
+        self.latency = latency
+        self.sites = {site.host: site for site in (Site('hm', 'www2.hm.com', product_count),
+                                                   Site('cos', 'www.cos.com', product_count))}
+        with open(os.path.join(FIXTURES, 'image.jpg'), 'rb') as f:
+            self.image = f.read()
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._server = _Server(('127.0.0.1', 0), self._handler())
+        self.address = f'127.0.0.1:{self._server.server_port}'
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def count(self, kind, size):
+        with self._lock:
+            count, total = self.requests.get(kind, (0, 0))
+            self.requests[kind] = (count + 1, total + size)
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                time.sleep(server.latency)
+                url = urlsplit(self.path)
+                site = server.sites.get(self.headers.get('X-Original-Host'))
+                if site is None:
+                    self.reply(200, 'image/jpeg', server.image, 'image')
+                    return
+                page = site.get(url.path, parse_qs(url.query))
+                if page is None:
+                    self.reply(404, 'text/plain', b'not found', 'not found')
+                    return
+                content_type, body = page
+                self.reply(200, content_type, body.encode(), content_type.split(';')[0])
+
+            def do_POST(self):
+                time.sleep(server.latency)
+                length = int(self.headers.get('Content-Length', 0))
+                self.rfile.read(length)
+                server.count('upload', length)
+                self.reply(200, 'text/plain', b'success', None)
+
+            def reply(self, status, content_type, body, kind):
+                if kind:
+                    server.count(kind, len(body))
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class StandInAdapter(requests.adapters.HTTPAdapter):
+    """Sends every request of the session it is mounted on to the stand-in server at address"""
+    def __init__(self, address, **kwargs):
+        self.address = address
+        super().__init__(pool_maxsize=64, **kwargs)
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        request.headers['X-Original-Host'] = url.netloc
+        request.url = urlunsplit(('http', self.address, url.path, url.query, ''))
+        return super().send(request, **kwargs)
+
+
+class StubTranslator:
+    """Stands in for deep_translator.GoogleTranslator: waits latency seconds and returns the text unchanged"""
+    latency = 0.1
+
+    def __init__(self, source='auto', target='ru'):
+        self.target = target
+
+    def translate(self, text):
+        time.sleep(self.latency)
+        return text
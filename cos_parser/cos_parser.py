@@ -2,6 +2,8 @@
 
 import requests
 from bs4 import BeautifulSoup
+from lxml import etree
+import lxml.html
 from pymongo import MongoClient
 
 
@@ -11,26 +13,65 @@ import os
 import re
 import sys
 import json
+from html import unescape
 import toml
-import shutil
+import threading
+from functools import lru_cache
+from time import time, perf_counter
+from concurrent.futures import ThreadPoolExecutor
 
-from utils import translate, download_and_save_image, loadPhoto, make_request
+try:
+    from .utils import translate_batch, download_images, PhotoUploader, make_request, init_session, BulkWriter, get_translation_cache, get_http_cache, search_stream, ensure_indexes, Checkpoint, Updater, get_parse_pool, parse_js_object, iter_stage, METRICS, report_metrics, serve_metrics
+except ImportError:
+    from utils import translate_batch, download_images, PhotoUploader, make_request, init_session, BulkWriter, get_translation_cache, get_http_cache, search_stream, ensure_indexes, Checkpoint, Updater, get_parse_pool, parse_js_object, iter_stage, METRICS, report_metrics, serve_metrics
 
 # ! CONFIG 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG = toml.load(f'CONFIG.toml')
 COS_CONFIG = CONFIG['ParserManager']['cos_parser_path']
+THREAD_COUNT = CONFIG['ParserManager'].get('cos_parser_thread_count', 1)
+PROCESS_COUNT = CONFIG['ParserManager'].get('cos_parser_process_count', os.cpu_count())
+INCREMENTAL = CONFIG['ParserManager'].get('cos_parser_incremental', False)
+UPDATE_THREAD_COUNT = CONFIG['ParserManager'].get('cos_available_updates_thread_count', 1)
+
+# fields of a stored product read by updateDocument
+UPDATE_PROJECTION = {'_id': False, 'article': True, 'colors': True, 'deliveryPrice': True,
+                     'originalPrice': True, 'price': True}
+
+# product page fields, read from the lxml tree without building a BeautifulSoup tree
+PRICE_XPATH = etree.XPath('//span[contains(concat(" ", normalize-space(@class), " "), " productPrice ")]')
+DESCRIPTION_XPATH = etree.XPath('//div[@id="description"]')
+
+# the same price element searched in the raw HTML of a streamed page
+PRICE_REGEXP = re.compile(r'<span[^>]*\sclass="(?:[^"]*\s)?productPrice(?:\s[^"]*)?"[^>]*>(.*?)</span>', re.DOTALL)
+PRICE_NUMBER_REGEXP = re.compile(r'[0-9][0-9 ]*(?:[.,][0-9]+)?')
+TAG_REGEXP = re.compile(r'<[^>]+>')
+PARAGRAPH_REGEXP = re.compile(r'<p>(.*?)</p>', re.DOTALL)
+
+PRODUCT_DATA_REGEXP = re.compile(r'var\s+productArticleDetails\s*=\s*')
+PRODUCT_DATA_REWRITES = [(re.compile(pattern, flags), replacement) for pattern, replacement, flags in (
+    (r'"sizeName" : "(.*)",', r'"sizeName" : "\1"', 0),
+    (r'"materials": \[([^\[\]]*)\],', '"materials": [""],', 0),
+    (r'"url":[^\n]*', '"url": "",', 0),
+    (r'"url": "",\s*}', '"url": ""}', 0),
+    (r'"image":\s*isDesktop\s*\?\s*"(.*)"\s*:\s*"(.*)"', r'"image": "\1"', 0),
+    (r'getPro"fullscreen":[^\n]*', '"fullscreen": "",', 0),
+    (r'"recommendedDelivery":[^\n]*', '"recommendedDelivery": ""', 0),
+    (r'"compositions": \[.*?\],', '"compositions": [],', re.DOTALL),
+    (r'"zoom":[^\n]*', '"zoom": ""', 0),
+)]
 
 class CosParser:
-    def __init__(self, categoryTableName, mode, headers, cookies, collection):
+    def __init__(self, categoryTableName, mode, collection):
         self.brand = 'cos'
+        # stored documents of the brand
+        self.brandFilter = {"brand": self.brand}
         self.host = 'https://www.cos.com'
         
         self.categoryTableName = categoryTableName
         self.mode = mode
-        self.headers = headers
-        self.cookies = cookies
         self.collection = collection
+        self.updater = Updater(collection, self.updateDocument, UPDATE_PROJECTION, UPDATE_THREAD_COUNT)
     
     def parse(self):
         if self.mode == 'parser':
@@ -44,195 +85,231 @@ class CosParser:
             sys.exit()
     
     def modeParser(self):
-        inserted_count = 0
-        urls = self.getAllProducts()
-        for url in urls:
-            data = {}
-            
-            print(f'{urls.index(url) + 1} of {len(urls)}. Parse URL:', url)
-            
-            response = requests.get(url, headers=self.headers, cookies=self.cookies)
-            html = response.text
-            
-            soup = BeautifulSoup(html, 'lxml')
-            
-            productData = self.getProductDataFromJS(html)
-            
-            name = translate(productData['name'])
-            originalPrice = float(soup.find('span', {'class': 'productPrice'}).text.strip()[2:].replace(',', '.'))
+        # articles already in the collection only get a price/availability refresh
+        if INCREMENTAL:
+            ensure_indexes(self.collection)
+        self.existing = self.loadExistingArticles() if INCREMENTAL else set()
+        # an unfinished run of the same category resumes, written articles are not fetched again
+        self.checkpoint = Checkpoint(f'cos:{self.categoryTableName}:{self.mode}')
+        if self.checkpoint.resumed:
+            print("Resume run:", self.checkpoint.run, "written:", self.checkpoint.count('written'))
+        metricsMark, started = METRICS.mark(), time()
+        
+        try:
+            with BulkWriter(self.collection, on_insert=self.checkpoint.mark_written) as self.writer, \
+                    PhotoUploader() as self.uploader, ThreadPoolExecutor(max_workers=THREAD_COUNT) as executor:
+                # listing -> dedupe -> fetch -> parse -> images -> write, every stage pulls lazily
+                # from the previous one and keeps a bounded number of products in flight
+                urls = self.getAllProducts()
+                pages = iter_stage(executor, self.fetchProduct,
+                                   ((url, f'{i + 1}') for i, url in enumerate(urls)), THREAD_COUNT * 2)
+                fields = iter_stage(get_parse_pool('cos', PROCESS_COUNT), parseProductPage, pages, PROCESS_COUNT * 2)
+                for url, data in iter_stage(executor, self.parseProduct, fields, THREAD_COUNT * 2):
+                    self.checkpoint.mark([data['article']], 'parsed')
+                    self.writer.insert(data)
+            # only a run that got through the whole listing is finished, anything raised above leaves it resumable
+            self.checkpoint.finish()
+        finally:
+            self.checkpoint.close()
+        print("Inserted:", self.writer.inserted_count)
+        if INCREMENTAL:
+            print("Updated:", self.writer.modified_count)
+            self.updater.print_counts()
+        cache = get_translation_cache()
+        print("Translation cache hits:", cache.hits, "misses:", cache.misses)
+        httpCache = get_http_cache()
+        print("HTTP cache hits:", httpCache.hits, "revalidated:", httpCache.revalidated, "misses:", httpCache.misses)
+        report_metrics(f'cos:{self.categoryTableName}:{self.mode}', metricsMark, time() - started)
+    
+    def fetchProduct(self, url, progress=''):
+        article = self.getArticle(url)
+        if self.checkpoint.resumed and self.checkpoint.is_written(article, self.collection, self.brandFilter):
+            print(f'{progress}. Skip written URL:', url)
+            return None
+        if article in self.existing:
+            self.updater.refresh(self.writer, {"article": article, **self.brandFilter})
+            return None
+        
+        print(f'{progress}. Parse URL:', url)
+        
+        with METRICS.timer('fetch'):
+            response = make_request(url, cache=True)
+        if response is None:
+            print("Skip URL:", url)
+            return None
+        self.checkpoint.mark([article], 'fetched')
+        return response.text
+    
+    def parseProduct(self, url, fields):
+        # the parse process measured its stages, they are recorded here
+        for stage, seconds in fields.pop('timings').items():
+            METRICS.observe(stage, seconds)
+        data = {}
+        
+        originalPrice = fields['originalPrice']
 
-            price = self.getPrice(originalPrice)
-            
-            fullArticle = re.search(r'[0-9]{10}', url).group(0)
-            productArticle = fullArticle[:-3]
-            uniq_article = self.brand + '_' + productArticle
-            
-            description = str(soup.find('div', {'id': 'description'}))
-            pattern = re.compile(r'<p>(.*?)</p>', re.DOTALL)
-            description = ' '.join([i.strip() for i in pattern.findall(description)])
+        price = self.getPrice(originalPrice)
+        
+        productArticle = self.getArticle(url)
+        uniq_article = self.brand + '_' + productArticle
+        
+        description = fields['description']
+        
+        material = []
+        for word in description.split('% '):
+            for i in self.MATERIALS.keys():
+                if word.lower().startswith(i):
+                    material.append(self.MATERIALS[i])
+                    break
+        with METRICS.timer('translate'):
+            name, description = translate_batch([fields['name'], description])
+        material = ';'.join(list(set(material)))
+        
+        colors = []
+        for colorFields in fields['colors']:
+            colorData = {}
+            originalColor = colorFields['name']
+            try:
+                color = self.COLORS[originalColor.upper()]['name']
+            except KeyError:
+                color = 'разноцветный'
+            try:
+                hexCode = self.COLORS[originalColor.upper()]['hexCode']
+            except KeyError:
+                hexCode = '#FFFFFF'
+            code = colorFields['key'][-3:]
             
-            material = []
-            for word in description.split('% '):
-                for i in self.MATERIALS.keys():
-                    if word.lower().startswith(i):
-                        material.append(self.MATERIALS[i])
-                        break
-            description = translate(description)
-            material = ';'.join(list(set(material)))
+            with METRICS.timer('images'):
+                imageFiles = download_images(colorFields['images'], f'{self.brand}_{productArticle}_{color.replace("/", "_")}')
             
-            colors = []
-            for key in productData.keys():
-                colorData = {}
-                if re.match(r'[0-9]{10}', key):
-                    originalColor = productData[key]['name']
-                    try:
-                        color = self.COLORS[originalColor.upper()]['name']
-                    except KeyError:
-                        color = 'разноцветный'
-                    try:
-                        hexCode = self.COLORS[originalColor.upper()]['hexCode']
-                    except KeyError:
-                        hexCode = '#FFFFFF'
-                    code = key[-3:]
-                    
-                    images = productData[key]['vAssets']
-                    
-                    imagePathes = []
-                    for image in images:
-                        img_url = 'http:' + image['thumbnail']
-                        
-                        filepath = download_and_save_image(img_url, f'photo/{self.brand}_{productArticle}_{color.replace("/", "_")}_{images.index(image)}')
-                        if filepath:
-                            imagePathes.append(filepath)
-                    
-                    loadPhoto(self.brand, productArticle, color, imagePathes)
-                    
-                    sizes = []
-                    
-                    for size in productData[key]['variants']:
-                        sizes.append({'name': size['sizeName'], 'code': size["sizeCode"], 'availability': ''})
-                    
-                    colorData['name'] = color
-                    colorData['originalName'] = originalColor
-                    colorData['code'] = code
-                    colorData['hexCode'] = hexCode
-                    colorData['sizes'] = sizes
-                    colors.append(colorData)
+            self.uploader.submit(self.brand, productArticle, color, imageFiles)
             
-            data['name'] = name
-            data['article'] = productArticle
-            data['uniq_article'] = uniq_article
-            data['brand'] = self.brand
-            data['type'] = self.PARSE_TYPE
-            data['category'] = self.CATEGORY
-            data['gender'] = self.GENDER
-            data['subcategory'] = self.SUBCATEGORY
-            data['description'] = description
-            data['price'] = price
-            data['originalPrice'] = originalPrice
-            data['deliveryPrice'] = self.DELIVERY_PRICE
+            sizes = []
             
-            data['colors'] = colors     
+            for size in colorFields['sizes']:
+                sizes.append({'name': size['name'], 'code': size['code'], 'availability': ''})
             
-            data['material'] = material
-            data['care'] = "Машинная стирка при температуре до 30ºC с коротким циклом отжима.Отбеливание запрещено.Гладить при температуре до 110ºC .Химчистка с тетрахлорэтиленом.Не использовать машинную сушку"
+            colorData['name'] = color
+            colorData['originalName'] = originalColor
+            colorData['code'] = code
+            colorData['hexCode'] = hexCode
+            colorData['sizes'] = sizes
+            colors.append(colorData)
+        
+        data['name'] = name
+        data['article'] = productArticle
+        data['uniq_article'] = uniq_article
+        data['brand'] = self.brand
+        data['type'] = self.PARSE_TYPE
+        data['category'] = self.CATEGORY
+        data['gender'] = self.GENDER
+        data['subcategory'] = self.SUBCATEGORY
+        data['description'] = description
+        data['price'] = price
+        data['originalPrice'] = originalPrice
+        data['deliveryPrice'] = self.DELIVERY_PRICE
+        
+        data['colors'] = colors     
+        
+        data['material'] = material
+        data['care'] = "Машинная стирка при температуре до 30ºC с коротким циклом отжима.Отбеливание запрещено.Гладить при температуре до 110ºC .Химчистка с тетрахлорэтиленом.Не использовать машинную сушку"
 
-            try:
-                result = self.collection.insert_one(data)
-                inserted_count += 1
-                
-                print("Inserted document ID:", result.inserted_id)
-            except Exception as e:
-                print(e)
-        print("Inserted:", inserted_count)
+        
+        return data
     
     def getAllProducts(self):
-        response = requests.get(self.CATEGORY_URL, headers=self.headers, cookies=self.cookies)
+        with METRICS.timer('listing'):
+            response = make_request(self.CATEGORY_URL, cache=True)
+        if response is None:
+            print("Skip URL:", self.CATEGORY_URL)
+            return
         html = response.text
-        soup = BeautifulSoup(html, 'lxml')
+        with METRICS.timer('listing_soup'):
+            soup = BeautifulSoup(html, 'lxml')
         
         urls = [i.find('a').get('href') for i in soup.find_all('div', class_="image-if-hover")]
-        urls = self.remove_duplicate_links(urls)
-        
-        return urls
+        yield from self.remove_duplicate_links(urls)
 
+    def getArticle(self, url):
+        return re.search(r'[0-9]{10}', url).group(0)[:-3]
+    
+    def loadExistingArticles(self):
+        # only the articles are kept in memory, a document is read when its product comes up
+        return {document['article'] for document in self.collection.find(self.brandFilter, {'_id': False, 'article': True})}
+    
     def remove_duplicate_links(self, links):
         seen_prefixes = set()
-        unique_links = []
 
         for link in links:
             prefix = re.match(r'.*\.([0-9]{10})\.html', link).group(1)[:7]
             if prefix not in seen_prefixes:
-                unique_links.append(link)
                 seen_prefixes.add(prefix)
-
-        return unique_links
+                yield link
     
     def modeUpdate(self):
-        filter_criteria = {"brand": self.brand}
-        projection = {'_id': False, 'article': True, 'colors': True, 'deliveryPrice': True}
-
-
-        result = self.collection.find(filter_criteria, projection)
-        updated_count = 0
-        for document in result:     
-            article = document['article']
-            print('Parse article:', article)
-            colors = document['colors']
-            self.DELIVERY_PRICE = document['deliveryPrice']
-            
-            url = f'https://www.cos.com/webservices_cos/service/product/cos-europe/availability/{article}.json'       
-            try:
-                jsonData = make_request(url, headers=self.headers).text
-            except:
+        metricsMark, started = METRICS.mark(), time()
+        writer = self.updater.run(self.brandFilter, 'cos_update')
+        print("Updated:", writer.modified_count)
+        self.updater.print_counts()
+        httpCache = get_http_cache()
+        print("HTTP cache hits:", httpCache.hits, "revalidated:", httpCache.revalidated, "misses:", httpCache.misses)
+        report_metrics('cos:update', metricsMark, time() - started)
+    
+    def updateDocument(self, document):
+        article = document['article']
+        print('Parse article:', article)
+        colors = document['colors']
+        deliveryPrice = document['deliveryPrice']
+        
+        filter_criteria = {"article": article, "brand": self.brand}
+        new_record = {}
+        url = f'https://www.cos.com/webservices_cos/service/product/cos-europe/availability/{article}.json'       
+        try:
+            jsonData = make_request(url).text
+        except:
+            print("Skip URL:", url)
+            return None
+        dct = json.loads(jsonData)
+        # full article -> availability, built once so every size is a single dict lookup
+        statuses = dict.fromkeys(dct['availability'], 'in_stock')
+        statuses.update(dict.fromkeys(dct['fewPieceLeft'], 'few_pieces_left'))
+        
+        # only the sizes whose availability changed are written, addressed by their position
+        for i, color in enumerate(colors):
+            prefix = f"{article}{color['code']}"
+            availabilities = [statuses.get(f"{prefix}{size['code']}", 'out_of_stock') for size in color['sizes']]
+            for j, (size, availability) in enumerate(zip(color['sizes'], availabilities)):
+                if size.get('availability') != availability:
+                    new_record[f'colors.{i}.sizes.{j}.availability'] = availability
+        if not new_record:
+            # availability is the same as stored, neither the price page nor a write is needed
+            return filter_criteria, new_record
+        
+        if statuses:
+            # the product page is streamed and closed as soon as the price element has been read
+            url = f'https://www.cos.com/en_eur/women/womenswear/tops/product.oversized-t-shirt-black.{next(iter(statuses))[:-3]}.html'
+            response = make_request(url, stream=True)
+            match = response and search_stream(response, PRICE_REGEXP)
+            if not match:
                 print("Skip URL:", url)
-                continue
-            dct = json.loads(jsonData)
-            availableProducts = dct['availability'] + dct['fewPieceLeft']
-            if availableProducts == []:
-                for i in range(len(colors)):
-                    for j in range(len(colors[i]['sizes'])):
-                        colors[i]['sizes'][j]['availability'] = 'out_of_stock'
-            else:
-                url = f'https://www.cos.com/en_eur/women/womenswear/tops/product.oversized-t-shirt-black.{availableProducts[0][:-3]}.html'
-                try:
-                    html = make_request(url, headers=self.headers).text
-                except:
-                    print("Skip URL:", url)
-                    continue
-                soup = BeautifulSoup(html, 'lxml')
-                originalPrice = float(soup.find('span', {'class': 'productPrice'}).text.strip()[2:].replace(',', '.'))
-                price = self.getPrice(originalPrice)
-                
-                for i in range(len(colors)):
-                    for j in range(len(colors[i]['sizes'])):
-                        fullArticle = str(article) + str(colors[i]['code']) + str(colors[i]['sizes'][j]['code'])
-                        
-                        if fullArticle in availableProducts:
-                            colors[i]['sizes'][j]['availability'] = 'in_stock'
-                        else:
-                            colors[i]['sizes'][j]['availability'] = 'out_of_stock'
-                    
-            filter_criteria = {"article": article} 
-            
-            new_record = {"originalPrice": originalPrice, "price": price, "colors": colors}
-                                    
-            try:
-                update_result = self.collection.update_one(filter_criteria, {'$set': new_record})
-                if update_result.modified_count == 1:
-                    updated_count += 1
-            except Exception as e:
-                print(e)
-
-
-        print("Updated:", updated_count)
+                return None
+            originalPrice = parsePrice(unescape(TAG_REGEXP.sub('', match.group(1))))
+            price = self.getPrice(originalPrice, deliveryPrice)
+            if originalPrice != document.get('originalPrice'):
+                new_record['originalPrice'] = originalPrice
+            if price != document.get('price'):
+                new_record['price'] = price
+        
+        return filter_criteria, new_record
     
     def gPriceDict(self, key):
         return float(self.PRICE_TABLE[key])
 
-    def getPrice(self, eur_price):
+    def getPrice(self, eur_price, deliveryPrice=None):
+        if deliveryPrice is None:
+            deliveryPrice = self.DELIVERY_PRICE
         cost_price = (float(eur_price) * self.gPriceDict(
-            'КУРС_EUR_RUB')) + (self.DELIVERY_PRICE * self.gPriceDict(
+            'КУРС_EUR_RUB')) + (deliveryPrice * self.gPriceDict(
             'КУРС_БЕЛ.РУБ_РУБ') * self.gPriceDict(
             'КУРС_EUR_БЕЛ.РУБ'))
         final_price = (cost_price) / (
@@ -243,37 +320,13 @@ class CosParser:
         return final_price
 
     def getProductDataFromJS(self, html):
-        regexp = re.compile(r'var\s+productArticleDetails\s*=\s*(\{.*?\});', re.DOTALL)
-
-
-        output_str = re.search(regexp, html).group(1).replace("'", '"')
-            
-        output_str = re.sub(r'"sizeName" : "(.*)",', r'"sizeName" : "\1"', output_str)
-        
-        output_str = re.sub(r'"materials": \[([^\[\]]*)\],', '"materials": [""],', output_str)
-        output_str = re.sub(r'"url":[^\n]*', '"url": "",', output_str)
-        output_str = re.sub(r'"url": "",\s*}', '"url": ""}', output_str)
-        output_str = re.sub(r'"image":\s*isDesktop\s*\?\s*"(.*)"\s*:\s*"(.*)"', r'"image": "\1"', output_str)
-        output_str = re.sub(r'getPro"fullscreen":[^\n]*', '"fullscreen": "",', output_str)
-        output_str = re.sub(r'"recommendedDelivery":[^\n]*', '"recommendedDelivery": ""', output_str)
-        pattern = re.compile(r'"compositions": \[.*?\],', re.DOTALL)
-        output_str = re.sub(pattern, '"compositions": [],', output_str)
-        
-        output_str = re.sub(r'"zoom":[^\n]*', '"zoom": ""', output_str)
-            
-        result = json.loads(output_str)
-        
-        return result
+        return getProductDataFromJS(html)
     
     def loadParserSettings(self):
-        with open(f'{COS_CONFIG}/categories.json', 'r', encoding='utf-8') as f:
-            categories = json.load(f)
-        with open(f'{COS_CONFIG}/colors.json', 'r', encoding='utf-8') as f:
-            self.COLORS = json.load(f)
-        with open(f'{COS_CONFIG}/materials.json', 'r', encoding='utf-8') as f:
-            self.MATERIALS = json.load(f)
-        with open(f'{COS_CONFIG}/priceTable.json', 'r', encoding='utf-8') as f:
-            self.PRICE_TABLE = json.load(f)
+        categories = loadConfigFile('categories.json')
+        self.COLORS = loadConfigFile('colors.json')
+        self.MATERIALS = loadConfigFile('materials.json')
+        self.PRICE_TABLE = loadConfigFile('priceTable.json')
         
         self.CATEGORY_URL = categories[self.categoryTableName]['url']
         self.PARSE_TYPE = categories[self.categoryTableName]['type_pars']
@@ -284,14 +337,121 @@ class CosParser:
         self.GENDER = categories[self.categoryTableName]['gender']
     
     def loadUpdateSettings(self):
-        with open(f'{COS_CONFIG}/priceTable.json', 'r', encoding='utf-8') as f:
-            self.PRICE_TABLE = json.load(f)
+        self.PRICE_TABLE = loadConfigFile('priceTable.json')
         
 
-def main(mode, category=None):
+def getProductDataFromJS(html):
+    start = PRODUCT_DATA_REGEXP.search(html).end()
+    end = html.index('};', start) + 1
+    
+    # fast path: patch the literal into JSON with precompiled rewrites and decode it in C
+    output_str = html[start:end].replace("'", '"')
+    for pattern, replacement in PRODUCT_DATA_REWRITES:
+        output_str = pattern.sub(replacement, output_str)
+    try:
+        return json.loads(output_str)
+    except ValueError:
+        # a value the rewrites do not cover (e.g. an apostrophe in a text), parse the JS itself
+        return parse_js_object(html, start)[0]
+
+
+@lru_cache(maxsize=None)
+def loadConfigFile(name):
+    # read once per process, the scheduler runs many categories on the same files
+    with open(f'{COS_CONFIG}/{name}', 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def parseProductPage(url, html):
+    # parse stage of modeParser, runs in the process pool
+    start = perf_counter()
+    fields = extractProduct(html)
+    fields['timings']['parse'] = perf_counter() - start
+    return fields
+
+
+def parsePrice(text):
+    # '€ 35,00', '€ 35.00' or '€ 35'
+    return float(PRICE_NUMBER_REGEXP.findall(text)[0].replace(',', '.').replace(' ', ''))
+
+
+def extractProduct(html):
+    """
+    Reads the fields of a product page, runs in the parse process pool.
+    Only the fields the parser uses are returned so little data is sent back.
+    """
+    timings = {}
+    start = perf_counter()
+    tree = lxml.html.document_fromstring(html)
+    timings['html_tree'] = perf_counter() - start
+    start = perf_counter()
+    productData = getProductDataFromJS(html)
+    timings['product_data'] = perf_counter() - start
+    
+    originalPrice = parsePrice(PRICE_XPATH(tree)[0].text_content())
+    
+    # a page without the description div is stored with an empty description
+    description = DESCRIPTION_XPATH(tree)
+    description = etree.tostring(description[0], encoding='unicode', method='html', with_tail=False) if description else ''
+    description = ' '.join([i.strip() for i in PARAGRAPH_REGEXP.findall(description)])
+    
+    colors = []
+    for key, colorData in productData.items():
+        if re.match(r'[0-9]{10}', key):
+            colors.append({
+                'key': key,
+                'name': colorData['name'],
+                'images': ['http:' + image['thumbnail'] for image in colorData['vAssets']],
+                'sizes': [{'name': size['sizeName'], 'code': size['sizeCode']} for size in colorData['variants']],
+            })
+    
+    return {
+        'name': productData['name'],
+        'originalPrice': originalPrice,
+        'description': description,
+        'colors': colors,
+        'timings': timings,
+    }
+
+
+_session_ready = False
+_session_lock = threading.Lock()
+
+
+def initSession():
+    # headers and the cookie bootstrap request are done once per process
+    global _session_ready
+    with _session_lock:
+        if _session_ready:
+            return
+        headers = {
+            "Cache-Control": "max-age=0",
+            "Sec-Ch-Ua": '"Chromium";v="119", "Not?A_Brand";v="24"',
+            "Sec-Ch-Ua-Mobile": "?0",
+            "Sec-Ch-Ua-Platform": '"Linux"',
+            "Upgrade-Insecure-Requests": "1",
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.6045.199 Safari/537.36",
+            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7",
+            "Sec-Fetch-Site": "same-origin",
+            "Sec-Fetch-Mode": "navigate",
+            "Sec-Fetch-User": "?1",
+            "Sec-Fetch-Dest": "document",
+            "Accept-Encoding": "gzip, deflate, br",
+            "Accept-Language": "ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7",
+            "Priority": "u=0, i"
+        }
+        
+        init_session(headers)
+        make_request('https://www.cos.com') # session cookies are kept by the shared session
+        init_session(cookies={'HMCORP_locale': 'pl_PL', 'HMCORP_currency': 'EUR', 'AKA_A2': 'A', 'countryId': 'PL'}, domain='.cos.com')
+        _session_ready = True
+
+
+def main(mode, category=None, dbClient=None):
     """
     :mode - parser or update
     :category - name of category
+    :dbClient - MongoClient shared by the scheduler, a new one is opened and closed when not given
     """
     print('[COS_PARSER]\nmode',mode,'\ncategory',category)
 
@@ -306,41 +466,21 @@ def main(mode, category=None):
         COLLECTION_NAME = 'Products'
 
     
-    dbClient = MongoClient(host=CONFIG['Server']['host'],port=CONFIG['Server']['port'],username='admin',password=CONFIG['Server']['db_password'])
+    ownClient = dbClient is None
+    if ownClient:
+        dbClient = MongoClient(host=CONFIG['Server']['host'],port=CONFIG['Server']['port'],username='admin',password=CONFIG['Server']['db_password'])
     db = dbClient['DB']
     collection = db[COLLECTION_NAME]
     
-    headers = {
-        "Host": "www.cos.com",
-        "Cache-Control": "max-age=0",
-        "Sec-Ch-Ua": '"Chromium";v="119", "Not?A_Brand";v="24"',
-        "Sec-Ch-Ua-Mobile": "?0",
-        "Sec-Ch-Ua-Platform": '"Linux"',
-        "Upgrade-Insecure-Requests": "1",
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.6045.199 Safari/537.36",
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7",
-        "Sec-Fetch-Site": "same-origin",
-        "Sec-Fetch-Mode": "navigate",
-        "Sec-Fetch-User": "?1",
-        "Sec-Fetch-Dest": "document",
-        "Accept-Encoding": "gzip, deflate, br",
-        "Accept-Language": "ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7",
-        "Priority": "u=0, i"
-    }
-    
-    cookies = dict(make_request('https://www.cos.com', headers=headers).cookies)
-    cookies.update({'HMCORP_locale': 'pl_PL', 'HMCORP_currency': 'EUR', 'AKA_A2': 'A', 'countryId': 'PL'})
+    initSession()
+    serve_metrics()
         
-    if 'photo' not in os.listdir():
-        os.mkdir('photo')
-    
-    parser = CosParser(category, mode, headers, cookies, collection)
+    parser = CosParser(category, mode, collection)
     parser.parse()
     
-    dbClient.close()
+    if ownClient:
+        dbClient.close()
     
-    shutil.rmtree('photo')
-
     return True
 
 
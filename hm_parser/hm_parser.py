@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
 import requests
-from bs4 import BeautifulSoup
+from lxml import etree
+import lxml.html
 from pymongo import MongoClient
 import toml
 
@@ -10,9 +11,16 @@ import os
 import re
 import sys
 import json
-import shutil
+from html import unescape
+import threading
+from functools import lru_cache
+from time import time, perf_counter
+from concurrent.futures import ThreadPoolExecutor
 
-from utils import translate, download_and_save_image, loadPhoto, make_request
+try:
+    from .utils import translate_batch, download_images, PhotoUploader, make_request, init_session, BulkWriter, get_translation_cache, get_http_cache, search_stream, ensure_indexes, Checkpoint, Updater, get_parse_pool, parse_js_object, iter_completed, iter_stage, METRICS, report_metrics, serve_metrics
+except ImportError:
+    from utils import translate_batch, download_images, PhotoUploader, make_request, init_session, BulkWriter, get_translation_cache, get_http_cache, search_stream, ensure_indexes, Checkpoint, Updater, get_parse_pool, parse_js_object, iter_completed, iter_stage, METRICS, report_metrics, serve_metrics
 
 
 
@@ -20,16 +28,60 @@ from utils import translate, download_and_save_image, loadPhoto, make_request
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG = toml.load(f'CONFIG.toml')
 HM_CONFIG = CONFIG['ParserManager']['hm_parser_path']
+THREAD_COUNT = CONFIG['ParserManager'].get('hm_parser_thread_count', 1)
+PROCESS_COUNT = CONFIG['ParserManager'].get('hm_parser_process_count', os.cpu_count())
+INCREMENTAL = CONFIG['ParserManager'].get('hm_parser_incremental', False)
+UPDATE_THREAD_COUNT = CONFIG['ParserManager'].get('hm_available_updates_thread_count', 1)
+LISTING_THREAD_COUNT = CONFIG['ParserManager'].get('hm_listing_thread_count', 1)
+
+# fields of a stored product read by updateDocument
+UPDATE_PROJECTION = {'_id': False, 'article': True, 'colors': True, 'deliveryPrice': True, 'brand': True,
+                     'originalPrice': True, 'price': True}
+
+# category listing pages
+LISTING_LINK_XPATH = etree.XPath('//div[contains(concat(" ", normalize-space(@class), " "), " c02f13 ")]/descendant::a[1]/@href')
+LISTING_PAGE_REGEXP = re.compile(r'href="[^"]*[?&](?:amp;)?page=([0-9]+)')
+LISTING_TOTAL_REGEXP = re.compile(r'data-total="([0-9]+)"')
+PAGE_SIZE_REGEXP = re.compile(r'(?<=[?&])page-size=[0-9]+')
+OFFSET_REGEXP = re.compile(r'(?<=[?&])offset=[0-9]+')
+
+# product page fields, read from the lxml tree without building a BeautifulSoup tree
+BRAND_XPATH = etree.XPath('//*[@id="js-product-name"]//h2')
+NAME_XPATH = etree.XPath('(//h1)[1]')
+PRICE_XPATH = etree.XPath('//span[contains(concat(" ", normalize-space(@class), " "), " price-value ")]')
+DESCRIPTION_XPATH = etree.XPath('//div[@id="section-descriptionAccordion"]//p')
+MATERIAL_XPATH = etree.XPath('//div[@id="section-materialsAndSuppliersAccordion"]//p')
+
+# the same price element searched in the raw HTML of a streamed page
+PRICE_REGEXP = re.compile(r'<span[^>]*\sclass="(?:[^"]*\s)?price-value(?:\s[^"]*)?"[^>]*>(.*?)</span>', re.DOTALL)
+PRICE_NUMBER_REGEXP = re.compile(r'[0-9 ]+,\d+')
+TAG_REGEXP = re.compile(r'<[^>]+>')
+
+PRODUCT_DATA_REGEXP = re.compile(r'var\s+productArticleDetails\s*=\s*')
+PRODUCT_DATA_REWRITES = [(re.compile(pattern), replacement) for pattern, replacement in (
+    (r'"materials": \[([^\[\]]*)\],', '"materials": [""],'),
+    (r'"url":[^\n]*', '"url": "",'),
+    (r'"thumbnail":[^\n]*', '"thumbnail": "",'),
+    (r'"image":\s*isDesktop\s*\?\s*"(.*)"\s*:\s*"(.*)"', r'"image": "\1"'),
+    (r'"fullscreen":[^\n]*', '"fullscreen": "",'),
+    (r'"recommendedDelivery":[^\n]*', '"recommendedDelivery": ""'),
+    (r'"brandPagePath":[^\n]*', '"brandPagePath": ""'),
+    (r'"zoom":[^\n]*', '"zoom": ""'),
+    (r'"deliveryBulkyText":[^\n]*', ',"deliveryBulkyText": ""'),
+    (r'"brandName": ([^\n]*),', '"brandName": ""'),
+)]
 
 
 class HMParser:
-    def __init__(self, categoryTableName, mode, headers, collection):
+    def __init__(self, categoryTableName, mode, collection):
         self.host = 'https://www2.hm.com'
+        # stored documents of the brand
+        self.brandFilter = {"brand": {"$in": ["h&m", "arket"]}}
         
         self.categoryTableName = categoryTableName
         self.mode = mode
-        self.headers = headers
         self.collection = collection
+        self.updater = Updater(collection, self.updateDocument, UPDATE_PROJECTION, UPDATE_THREAD_COUNT)
     
     def parse(self):
         if self.mode == 'parser':
@@ -43,239 +95,285 @@ class HMParser:
             sys.exit()
     
     def modeParser(self):    
-        products = self.getAllProducts()
+        # articles already in the collection only get a price/availability refresh
+        if INCREMENTAL:
+            ensure_indexes(self.collection)
+        self.existing = self.loadExistingArticles() if INCREMENTAL else set()
+        # an unfinished run of the same category resumes, written articles are not fetched again
+        self.checkpoint = Checkpoint(f'hm:{self.categoryTableName}:{self.mode}')
+        if self.checkpoint.resumed:
+            print("Resume run:", self.checkpoint.run, "written:", self.checkpoint.count('written'))
+        metricsMark, started = METRICS.mark(), time()
         
-        inserted_count = 0
-        urls = []
-        for product in products:
-            url = product['href']
-            urls.append(url)
+        try:
+            with BulkWriter(self.collection, on_insert=self.checkpoint.mark_written) as self.writer, \
+                    PhotoUploader() as self.uploader, ThreadPoolExecutor(max_workers=THREAD_COUNT) as executor:
+                # listing -> dedupe -> fetch -> parse -> images -> write, every stage pulls lazily
+                # from the previous one and keeps a bounded number of products in flight
+                urls = self.remove_duplicate_links(self.getAllProducts())
+                pages = iter_stage(executor, self.fetchProduct,
+                                   ((url, f'{i + 1}') for i, url in enumerate(urls)), THREAD_COUNT * 2)
+                fields = iter_stage(get_parse_pool('hm', PROCESS_COUNT), parseProductPage, pages, PROCESS_COUNT * 2)
+                for url, data in iter_stage(executor, self.parseProduct, fields, THREAD_COUNT * 2):
+                    self.checkpoint.mark([data['article']], 'parsed')
+                    self.writer.insert(data)
+            # only a run that got through the whole listing is finished, anything raised above leaves it resumable
+            self.checkpoint.finish()
+        finally:
+            self.checkpoint.close()
+        print("Inserted:", self.writer.inserted_count)
+        if INCREMENTAL:
+            print("Updated:", self.writer.modified_count)
+            self.updater.print_counts()
+        cache = get_translation_cache()
+        print("Translation cache hits:", cache.hits, "misses:", cache.misses)
+        httpCache = get_http_cache()
+        print("HTTP cache hits:", httpCache.hits, "revalidated:", httpCache.revalidated, "misses:", httpCache.misses)
+        report_metrics(f'hm:{self.categoryTableName}:{self.mode}', metricsMark, time() - started)
+    
+    def fetchProduct(self, url, progress=''):
+        article = self.getArticle(url)
+        if self.checkpoint.resumed and self.checkpoint.is_written(article, self.collection, self.brandFilter):
+            print(f'{progress}. Skip written URL:', url)
+            return None
+        if article in self.existing:
+            self.updater.refresh(self.writer, {"article": article, **self.brandFilter})
+            return None
         
-        urls = self.remove_duplicate_links(urls)
+        print(f'{progress}. Parse URL:', url)
         
-        for url in urls:
-            data = {}
-            
-            print(f'{urls.index(url) + 1} of {len(urls)}. Parse URL:', url)
-            
-            response = make_request(url, headers=self.headers)
-            html = response.text
-            
-            """with open('last_page.html', 'w') as f:
-                f.write(html)"""
-            
-            soup = BeautifulSoup(html, 'lxml')
-            brand = soup.select_one('#js-product-name h2')
-            if brand:
-                brand = brand.text.strip().lower()
-            else:
-                brand = 'h&m'
-
-            name = translate(soup.h1.text)
-            productArticle = re.search(r'\.[0-9]+\.', url).group()[1:-4] # H&M_0975846001_XXS
-            uniq_article = f'{brand}_{productArticle}'
-            
-            
-            originalPrice = soup.find('span', class_='price-value').text
-            if 'Cena dla Klubowiczów' in originalPrice:
-                originalPrice = originalPrice[:originalPrice.find('Cena dla Klubowiczów')]
-            originalPrice = float(re.findall(r'[0-9 ]+,\d+', originalPrice)[0].replace(',', '.').replace(' ', '').strip())
-            price = self.getPrice(originalPrice)
-                    
-            description = translate(soup.find('div', id='section-descriptionAccordion').find('p').text)
-            material = translate(soup.find('div', id='section-materialsAndSuppliersAccordion').find('p').text)
-
-            productData = self.getProductDataFromJS(html)
-
-            colors = []
-            for key in productData.keys():
-                colorData = {}
-                if re.match(r'[0-9]{10}', key):
-                    originalColor = productData[key]['name']
-                    try:
-                        color = self.COLORS[originalColor]
-                    except KeyError:
-                        color = 'разноцветный'
-                    hexCode = productData[key]['rgb']
-                    code = key[-3:]
-                    
-                    images = productData[key]['images']
-                    
-                    imagePathes = []
-                    for image in images:
-                        img_url = 'http:' + image['image']
-                        
-                        filepath = download_and_save_image(img_url, f'photo/{brand}_{productArticle}_{color.replace("/", "_")}_{images.index(image)}')
-                        if filepath:
-                            imagePathes.append(filepath)
-                    loadPhoto(brand, productArticle, color, imagePathes)
-                    
-                    sizes = []
-                    
-                    for size in productData[key]['sizes']:
-                        sizes.append({'name': size['name'], 'code': size["size"], 'availability': ''})
-                    
-                    colorData['name'] = color
-                    colorData['originalName'] = originalColor
-                    colorData['code'] = code
-                    colorData['hexCode'] = hexCode
-                    colorData['sizes'] = sizes
-                    colors.append(colorData)
-            
+        with METRICS.timer('fetch'):
+            response = make_request(url, cache=True)
+        if response is None:
+            print("Skip URL:", url)
+            return None
+        self.checkpoint.mark([article], 'fetched')
+        return response.text
+    
+    def parseProduct(self, url, fields):
+        # the parse process measured its stages, they are recorded here
+        for stage, seconds in fields.pop('timings').items():
+            METRICS.observe(stage, seconds)
+        data = {}
+        
+        brand = fields['brand']
 
+        productArticle = self.getArticle(url) # H&M_0975846001_XXS
+        uniq_article = f'{brand}_{productArticle}'
+        
+        originalPrice = fields['originalPrice']
+        price = self.getPrice(originalPrice)
+                
+        with METRICS.timer('translate'):
+            name, description, material = translate_batch([fields['name'], fields['description'], fields['material']])
+
+        colors = []
+        for colorFields in fields['colors']:
+            colorData = {}
+            originalColor = colorFields['name']
+            try:
+                color = self.COLORS[originalColor]
+            except KeyError:
+                color = 'разноцветный'
+            hexCode = colorFields['rgb']
+            code = colorFields['key'][-3:]
             
-            data['name'] = name
-            data['article'] = productArticle
-            data['uniq_article'] = uniq_article
-            data['brand'] = brand
-            data['type'] = self.PARSE_TYPE
-            data['category'] = self.CATEGORY
-            data['gender'] = self.GENDER
-            data['subcategory'] = self.SUBCATEGORY
-            data['description'] = description
-            data['price'] = price
-            data['originalPrice'] = originalPrice
-            data['deliveryPrice'] = self.DELIVERY_PRICE
+            with METRICS.timer('images'):
+                imageFiles = download_images(colorFields['images'], f'{brand}_{productArticle}_{color.replace("/", "_")}')
+            self.uploader.submit(brand, productArticle, color, imageFiles)
             
-            data['colors'] = colors     
-            data['material'] = material
-            data['care'] = "Машинная стирка при температуре до 30ºC с коротким циклом отжима.Отбеливание запрещено.Гладить при температуре до 110ºC .Химчистка с тетрахлорэтиленом.Не использовать машинную сушку"
+            sizes = []
             
-            try:
-                result = self.collection.insert_one(data)
-                inserted_count += 1
-                
-                print("Inserted document ID:", result.inserted_id)
-            except Exception as e:
-                print(e)
-        print("Inserted:", inserted_count)
+            for size in colorFields['sizes']:
+                sizes.append({'name': size['name'], 'code': size['code'], 'availability': ''})
+            
+            colorData['name'] = color
+            colorData['originalName'] = originalColor
+            colorData['code'] = code
+            colorData['hexCode'] = hexCode
+            colorData['sizes'] = sizes
+            colors.append(colorData)
+        
+        data['name'] = name
+        data['article'] = productArticle
+        data['uniq_article'] = uniq_article
+        data['brand'] = brand
+        data['type'] = self.PARSE_TYPE
+        data['category'] = self.CATEGORY
+        data['gender'] = self.GENDER
+        data['subcategory'] = self.SUBCATEGORY
+        data['description'] = description
+        data['price'] = price
+        data['originalPrice'] = originalPrice
+        data['deliveryPrice'] = self.DELIVERY_PRICE
+        
+        data['colors'] = colors     
+        data['material'] = material
+        data['care'] = "Машинная стирка при температуре до 30ºC с коротким циклом отжима.Отбеливание запрещено.Гладить при температуре до 110ºC .Химчистка с тетрахлорэтиленом.Не использовать машинную сушку"
+        
+        return data
     
     def modeUpdate(self):
-        filter_criteria = {"brand": {"$in": ["h&m", "arket"]}}
-        projection = {'_id': False, 'article': True, 'colors': True, 'deliveryPrice': True, 'brand': True}
-
-
-        result = self.collection.find(filter_criteria, projection)
-        updated_count = 0
-        for document in result:            
-            article = document['article']
-            colors = document['colors']
-            brand = document['brand']
-            self.DELIVERY_PRICE = document['deliveryPrice']
-            
-            try:
-                url = f'https://www2.hm.com/hmwebservices/service/product/pl/availability/{article}.json'   
-                try:    
-                    jsonData = make_request(url, headers=self.headers).text
-                except:
-                    print("Skip URL:", url)
-                    continue
-                dct = json.loads(jsonData)
-                availableProducts = dct['availability'] + dct['fewPieceLeft']
-                if availableProducts == []:
-                    for i in range(len(colors)):
-                        for j in range(len(colors[i]['sizes'])):
-                            colors[i]['sizes'][j]['availability'] = 'out_of_stock'
-                else:
-                    url = f'https://www2.hm.com/pl_pl/productpage.{availableProducts[0][:-3]}.html'
-                    print('Parse URL:', url)
-                    try:
-                        html = make_request(url, headers=self.headers).text
-                    except:
-                        print("Skip URL:", url)
-                        continue
-                    soup = BeautifulSoup(html, 'lxml')
-                    originalPrice = float(soup.find('span', class_='price-value').text.strip().replace(' PLN', '').replace(',', '.'))
-                    price = self.getPrice(originalPrice)
-                    
-                    for i in range(len(colors)):
-                        for j in range(len(colors[i]['sizes'])):
-                            fullArticle = str(article) + str(colors[i]['code']) + str(colors[i]['sizes'][j]['code'])
-                            if fullArticle in availableProducts:
-                                colors[i]['sizes'][j]['availability'] = 'in_stock'
-                            else:
-                                colors[i]['sizes'][j]['availability'] = 'out_of_stock'
+        metricsMark, started = METRICS.mark(), time()
+        writer = self.updater.run(self.brandFilter, 'hm_update')
+        print("Updated:", writer.modified_count)
+        self.updater.print_counts()
+        httpCache = get_http_cache()
+        print("HTTP cache hits:", httpCache.hits, "revalidated:", httpCache.revalidated, "misses:", httpCache.misses)
+        report_metrics('hm:update', metricsMark, time() - started)
+    
+    def updateDocument(self, document):
+        article = document['article']
+        colors = document['colors']
+        brand = document['brand']
+        deliveryPrice = document['deliveryPrice']
+        
+        filter_criteria = {"article": article, "brand": brand}
+        new_record = {}
+        try:
+            url = f'https://www2.hm.com/hmwebservices/service/product/pl/availability/{article}.json'   
+            try:    
+                jsonData = make_request(url).text
             except:
                 print("Skip URL:", url)
-                continue
-            filter_criteria = {"article": article, "brand": brand}
+                return None
+            dct = json.loads(jsonData)
+            # full article -> availability, built once so every size is a single dict lookup
+            statuses = dict.fromkeys(dct['availability'], 'in_stock')
+            statuses.update(dict.fromkeys(dct['fewPieceLeft'], 'few_pieces_left'))
             
-            new_record = {"originalPrice": originalPrice, "price": price, "colors": colors}
-            try:
-                update_result = self.collection.update_one(filter_criteria, {'$set': new_record})
-                if update_result.modified_count == 1:
-                    updated_count += 1
-            except Exception as e:
-                print(e)
-
-
-        print("Updated:", updated_count)
+            # only the sizes whose availability changed are written, addressed by their position
+            for i, color in enumerate(colors):
+                prefix = f"{article}{color['code']}"
+                availabilities = [statuses.get(f"{prefix}{size['code']}", 'out_of_stock') for size in color['sizes']]
+                for j, (size, availability) in enumerate(zip(color['sizes'], availabilities)):
+                    if size.get('availability') != availability:
+                        new_record[f'colors.{i}.sizes.{j}.availability'] = availability
+            if not new_record:
+                # availability is the same as stored, neither the price page nor a write is needed
+                return filter_criteria, new_record
+            
+            if statuses:
+                # the product page is streamed and closed as soon as the price element has been read
+                url = f'https://www2.hm.com/pl_pl/productpage.{next(iter(statuses))[:-3]}.html'
+                print('Parse URL:', url)
+                response = make_request(url, stream=True)
+                match = response and search_stream(response, PRICE_REGEXP)
+                if not match:
+                    print("Skip URL:", url)
+                    return None
+                originalPrice = parsePrice(unescape(TAG_REGEXP.sub('', match.group(1))))
+                price = self.getPrice(originalPrice, deliveryPrice)
+                if originalPrice != document.get('originalPrice'):
+                    new_record['originalPrice'] = originalPrice
+                if price != document.get('price'):
+                    new_record['price'] = price
+        except:
+            print("Skip URL:", url)
+            return None
+        
+        return filter_criteria, new_record
     
     def getAllProducts(self):
-        products = []
-        page = 1
-        
-        response = make_request(self.CATEGORY_URL + f'&page={page}', headers=self.headers)
+        """
+        Yields product links of the category.
+        The page count is worked out from the first page, the other pages are fetched
+        concurrently and their links are yielded as soon as a page arrives.
+        A pagination that only shows nearby pages extends the count as later pages arrive.
+        """
+        url = self.getListingUrl(1)
+        with METRICS.timer('listing'):
+            response = make_request(url, cache=True)
+        if response is None:
+            print("Skip URL:", url)
+            return
         html = response.text
-        soup = BeautifulSoup(html, 'lxml')
+        links = LISTING_LINK_XPATH(lxml.html.document_fromstring(html))
+        yield from links
+        
+        # pages from the pagination links are fetched by number, like the site links them
+        pageSize = None
+        pageCount = self.getPageCount(html)
+        total = LISTING_TOTAL_REGEXP.search(html)
+        if pageCount is None and total and links:
+            # only the product total is known: the pages hold as many products as the site showed on the first one
+            # (the page-size of the category URL is not honoured), an offset URL is paged by that size
+            pageSize = len(links)
+            pageCount = -(-int(total.group(1)) // pageSize)
+        
+        if pageCount is None:
+            # no pagination on the page, walk the pages until one comes back empty or repeats
+            page = 1
+            while links:
+                page += 1
+                previous, (links, _) = links, self.getListingPage(page)
+                if links == previous:
+                    break
+                yield from links
+            return
         
-        nextBlocked = soup.find('button', class_='f05bd4 aa68da aaa2a2 f8c3c8 ab0e07')
-        next = True
-        while not nextBlocked and next:
-            page += 1
-            onePageProducts = soup.find_all('div', class_='c02f13')
-            onePageProducts = [i.find('a') for i in onePageProducts]
-            products.extend(onePageProducts)
-            response = make_request(self.CATEGORY_URL + f'&page={page}', headers=self.headers)
-            html = response.text
-            soup = BeautifulSoup(html, 'lxml')
-            nextBlocked = soup.find('button', class_='f05bd4 aa68da aaa2a2 f8c3c8 ab0e07')
-            next = soup.find('button', class_='f05bd4 aaa2a2 ab0e07')
-        return products
+        fetched = 1
+        with ThreadPoolExecutor(max_workers=LISTING_THREAD_COUNT) as executor:
+            while fetched < pageCount:
+                jobs = ((page, self.getListingPage, page, pageSize) for page in range(fetched + 1, pageCount + 1))
+                fetched = pageCount
+                for page, future in iter_completed(executor, jobs, LISTING_THREAD_COUNT):
+                    links, lastPage = future.result()
+                    if pageSize is None:
+                        pageCount = max(pageCount, lastPage or 0)
+                    yield from links
+    
+    def getListingUrl(self, page, pageSize=None):
+        """
+        :pageSize - products per page measured on the first page, given only when the page count
+                    comes from the product total; an offset/page-size URL is then paged by offset
+        """
+        if pageSize and OFFSET_REGEXP.search(self.CATEGORY_URL):
+            url = OFFSET_REGEXP.sub(f'offset={(page - 1) * pageSize}', self.CATEGORY_URL)
+            return PAGE_SIZE_REGEXP.sub(f'page-size={pageSize}', url)
+        return self.CATEGORY_URL + f'&page={page}'
+    
+    def getListingPage(self, page, pageSize=None):
+        url = self.getListingUrl(page, pageSize)
+        with METRICS.timer('listing'):
+            response = make_request(url, cache=True)
+        if response is None:
+            print("Skip URL:", url)
+            return [], None
+        return LISTING_LINK_XPATH(lxml.html.document_fromstring(response.text)), self.getPageCount(response.text)
+    
+    def getPageCount(self, html):
+        # the last page number from the pagination links
+        pages = [int(page) for page in LISTING_PAGE_REGEXP.findall(html)]
+        return max(pages) if pages else None
+    
+    def getArticle(self, url):
+        return re.search(r'\.[0-9]+\.', url).group()[1:-4]
+    
+    def loadExistingArticles(self):
+        # only the articles are kept in memory, a document is read when its product comes up
+        return {document['article'] for document in self.collection.find(self.brandFilter, {'_id': False, 'article': True})}
     
     def remove_duplicate_links(self, links):
         seen_prefixes = set()
-        unique_links = []
 
         for link in links:
             prefix = re.match(r'.*\.([0-9]{10})\.html', link).group(1)[:7]
             if prefix not in seen_prefixes:
-                unique_links.append(link)
                 seen_prefixes.add(prefix)
-
-        return unique_links
+                yield link
     
     def getProductDataFromJS(self, html):
-        regexp = re.compile(r'var\s+productArticleDetails\s*=\s*(\{.*?\});', re.DOTALL)
-
-
-        output_str = re.search(regexp, html).group(1).replace("'", '"')
-
-        output_str = re.sub(r'"materials": \[([^\[\]]*)\],', '"materials": [""],', output_str)
-        output_str = re.sub(r'"url":[^\n]*', '"url": "",', output_str)
-        output_str = re.sub(r'"thumbnail":[^\n]*', '"thumbnail": "",', output_str)
-        output_str = re.sub(r'"image":\s*isDesktop\s*\?\s*"(.*)"\s*:\s*"(.*)"', r'"image": "\1"', output_str)
-        output_str = re.sub(r'"fullscreen":[^\n]*', '"fullscreen": "",', output_str)
-        output_str = re.sub(r'"recommendedDelivery":[^\n]*', '"recommendedDelivery": ""', output_str)
-        output_str = re.sub(r'"brandPagePath":[^\n]*', '"brandPagePath": ""', output_str)
-        output_str = re.sub(r'"zoom":[^\n]*', '"zoom": ""', output_str)
-        output_str = re.sub(r'"deliveryBulkyText":[^\n]*', ',"deliveryBulkyText": ""', output_str)
-        output_str = re.sub(r'"brandName": ([^\n]*),', '"brandName": ""', output_str)
-            
-        """with open('output.json', 'w') as f:
-            f.write(output_str)"""
-            
-        result = json.loads(output_str)
-        
-        return result
-        
+        return getProductDataFromJS(html)
     
     def gPriceDict(self, key):
         return float(self.PRICE_TABLE[key])
 
-    def getPrice(self, pln_price):
+    def getPrice(self, pln_price, deliveryPrice=None):
+        if deliveryPrice is None:
+            deliveryPrice = self.DELIVERY_PRICE
         cost_price = ((float(pln_price) / self.gPriceDict("КУРС_USD_ЗЛОТЫ")) * self.gPriceDict("КОЭФ_КОНВЕРТАЦИИ") * self.gPriceDict(
-            'КУРС_USD_RUB')) + (self.DELIVERY_PRICE * self.gPriceDict('КУРС_БЕЛ.РУБ_РУБ') * self.gPriceDict(
+            'КУРС_USD_RUB')) + (deliveryPrice * self.gPriceDict('КУРС_БЕЛ.РУБ_РУБ') * self.gPriceDict(
             'КУРС_EUR_БЕЛ.РУБ'))
         final_price = (cost_price ) / (
                     1 - self.gPriceDict('НАЦЕНКА')  - self.gPriceDict('ПРОЦЕНТЫ_НАЛОГ') - self.gPriceDict('ПРОЦЕНТЫ_ЭКВАЙРИНГ'))
@@ -284,12 +382,9 @@ class HMParser:
         return final_price
     
     def loadParserSettings(self):
-        with open(f'{HM_CONFIG}/categories.json', 'r', encoding='utf-8') as f:
-            categories = json.load(f)
-        with open(f'{HM_CONFIG}/colors.json', 'r', encoding='utf-8') as f:
-            self.COLORS = json.load(f)
-        with open(f'{HM_CONFIG}/priceTable.json', 'r', encoding='utf-8') as f:
-            self.PRICE_TABLE = json.load(f)
+        categories = loadConfigFile('categories.json')
+        self.COLORS = loadConfigFile('colors.json')
+        self.PRICE_TABLE = loadConfigFile('priceTable.json')
         
         self.CATEGORY_URL = categories[self.categoryTableName]['url']
         self.PARSE_TYPE = categories[self.categoryTableName]['type_pars']
@@ -300,14 +395,112 @@ class HMParser:
         self.GENDER = categories[self.categoryTableName]['gender']
     
     def loadUpdateSettings(self):
-        with open(f'{HM_CONFIG}/priceTable.json', 'r', encoding='utf-8') as f:
-            self.PRICE_TABLE = json.load(f)
+        self.PRICE_TABLE = loadConfigFile('priceTable.json')
     
 
-def main(mode, category=None):
+def getProductDataFromJS(html):
+    start = PRODUCT_DATA_REGEXP.search(html).end()
+    end = html.index('};', start) + 1
+    
+    # fast path: patch the literal into JSON with precompiled rewrites and decode it in C
+    output_str = html[start:end].replace("'", '"')
+    for pattern, replacement in PRODUCT_DATA_REWRITES:
+        output_str = pattern.sub(replacement, output_str)
+    try:
+        return json.loads(output_str)
+    except ValueError:
+        # a value the rewrites do not cover (e.g. an apostrophe in a text), parse the JS itself
+        return parse_js_object(html, start)[0]
+
+
+@lru_cache(maxsize=None)
+def loadConfigFile(name):
+    # read once per process, the scheduler runs many categories on the same files
+    with open(f'{HM_CONFIG}/{name}', 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def parseProductPage(url, html):
+    # parse stage of modeParser, runs in the process pool
+    start = perf_counter()
+    fields = extractProduct(html)
+    fields['timings']['parse'] = perf_counter() - start
+    return fields
+
+
+def parsePrice(text):
+    # the club member price shown after the regular one is ignored
+    if 'Cena dla Klubowiczów' in text:
+        text = text[:text.find('Cena dla Klubowiczów')]
+    return float(PRICE_NUMBER_REGEXP.findall(text)[0].replace(',', '.').replace(' ', '').strip())
+
+
+def extractProduct(html):
+    """
+    Reads the fields of a product page, runs in the parse process pool.
+    Only the fields the parser uses are returned so little data is sent back.
+    """
+    timings = {}
+    start = perf_counter()
+    tree = lxml.html.document_fromstring(html)
+    timings['html_tree'] = perf_counter() - start
+    brand = BRAND_XPATH(tree)
+    if brand:
+        brand = brand[0].text_content().strip().lower()
+    else:
+        brand = 'h&m'
+    
+    originalPrice = parsePrice(PRICE_XPATH(tree)[0].text_content())
+    
+    start = perf_counter()
+    productData = getProductDataFromJS(html)
+    timings['product_data'] = perf_counter() - start
+    
+    colors = []
+    for key, colorData in productData.items():
+        if re.match(r'[0-9]{10}', key):
+            colors.append({
+                'key': key,
+                'name': colorData['name'],
+                'rgb': colorData['rgb'],
+                'images': ['http:' + image['image'] for image in colorData['images']],
+                'sizes': [{'name': size['name'], 'code': size['size']} for size in colorData['sizes']],
+            })
+    
+    return {
+        'brand': brand,
+        'originalPrice': originalPrice,
+        'name': NAME_XPATH(tree)[0].text_content(),
+        'description': DESCRIPTION_XPATH(tree)[0].text_content(),
+        'material': MATERIAL_XPATH(tree)[0].text_content(),
+        'colors': colors,
+        'timings': timings,
+    }
+
+
+_session_ready = False
+_session_lock = threading.Lock()
+
+
+def initSession():
+    # the shared session is set up once per process
+    global _session_ready
+    with _session_lock:
+        if _session_ready:
+            return
+        headers = {
+                'User-Agent': '123'
+            }
+        
+        init_session(headers)
+        _session_ready = True
+
+
+def main(mode, category=None, dbClient=None):
     """
     :mode - parser or update
     :category - name of category
+    :dbClient - MongoClient shared by the scheduler, a new one is opened and closed when not given
     """
     print('[HM_PARSER]\nmode',mode,'\ncategory',category)
     DB_NAME = 'DB'
@@ -324,24 +517,21 @@ def main(mode, category=None):
         COLLECTION_NAME = 'tmp_Products'
 
     
-    dbClient = MongoClient(host=CONFIG['Server']['host'],port=CONFIG['Server']['port'],username='admin',password=CONFIG['Server']['db_password'])
+    ownClient = dbClient is None
+    if ownClient:
+        dbClient = MongoClient(host=CONFIG['Server']['host'],port=CONFIG['Server']['port'],username='admin',password=CONFIG['Server']['db_password'])
 
     db = dbClient[DB_NAME]
     collection = db[COLLECTION_NAME]
     
-    headers = {
-            'User-Agent': '123'
-        }
+    initSession()
+    serve_metrics()
     
-    if 'photo' not in os.listdir():
-        os.mkdir('photo')
-    
-    parser = HMParser(category, mode, headers, collection)
+    parser = HMParser(category, mode, collection)
     parser.parse()
     
-    dbClient.close()
-
-    shutil.rmtree('photo')
+    if ownClient:
+        dbClient.close()
 
     
     return True
@@ -1,93 +1,31 @@
-import requests
-from deep_translator import GoogleTranslator
-import traceback
-import urllib3
-from urllib3.exceptions import InsecureRequestWarning
 import os
-from requests.exceptions import RequestException
-from time import sleep
+import sys
+from functools import partial
 
-from PIL import Image
-from io import BytesIO
-import imghdr
 import toml
-import traceback
 
-CONFIG = toml.load(f'CONFIG.toml')
-
-def loadPhoto(brand, article, color, imagePathes):
-    upload_url = 'https://83.147.245.51:5000/upload_imgs/{}_{}_{}'
-    upload_url = upload_url.format(brand, article, color.replace('/','_'))
-
-    files = {}
-    for imagePath in imagePathes:
-        filename = os.path.basename(imagePath)
-        
-        files[filename] = open(imagePath, 'rb')
-    
-    try:
-        response = make_request(upload_url, 'post', files=files).text
-        if response.lower() == 'success':
-            return True
-        raise Exception(f'Error! Response: {response}')
-    except Exception as e:
-        print(e)
-        return False
-    
-
-
-def translate(text, retries=2, delay=1):
-    for _ in range(retries + 1): # retries 3 times
-        try:
-            translated = GoogleTranslator(source='auto', target='ru').translate(text)
-            return translated
-        except Exception as e:
-            print(f"Error: {e}")
-            if _ < retries:
-                print(f"Retrying in {delay} seconds...")
-                sleep(delay)
-    return None
+# the parsers also run as scripts from their own folder, parser_utils is in the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.append(ROOT)
+import parser_utils
+from parser_utils import HttpClient, BulkWriter, Checkpoint, ShardPlan, Updater, get_parse_pool, ensure_indexes, get_translation_cache, get_http_cache, get_image_store, search_stream, iter_completed, iter_stage, parse_js_object, METRICS, timed, report_metrics, serve_metrics
 
-
-def download_and_save_image(url, filepath):
-    try:
-        response = make_request(url)
-    
-        if response.status_code == 200:
-            image_format = 'jpg'
-
-            if image_format:
-                image = Image.open(BytesIO(response.content))
-
-                save_path = filepath + '.' + image_format
-                
-                image.save(save_path)
-                return save_path
-    except:
-        traceback.print_exc()
-        print("Error downloading image. URL:", url)
-    return None
-
-
-def make_request(url, method='get', headers=None, cookies=None, files=None, retries=2, delay=1):
-    urllib3.disable_warnings(InsecureRequestWarning) # disable https invalid cert verification warnings
-    
-    for _ in range(retries + 1):
-        try:
-            if method == 'post':
-                response = requests.post(url, headers=headers, cookies=cookies, files=files, verify=False)
-            else:
-                response = requests.get(url, headers=headers, cookies=cookies)
-            """with open('last_page.html', 'w') as f:
-                f.write(response.text)"""
-            response.raise_for_status()  # Бросает исключение для 4xx и 5xx кодов ответа
-            return response
-        except RequestException as e:
-            print(f"Error: {e}")
-            if _ < retries:
-                print(f"Retrying in {delay} seconds...")
-                sleep(delay)
-    return None  # Если все попытки завершились неудачей
+CONFIG = toml.load(f'CONFIG.toml')
+HOST_LIMIT = CONFIG['ParserManager'].get('hm_parser_host_limit', 4)
+HOST_MAX_LIMIT = max(HOST_LIMIT, CONFIG['ParserManager'].get('hm_parser_host_max_limit', HOST_LIMIT))
+HOST_RATE = CONFIG['ParserManager'].get('hm_parser_host_rate', 0)
+
+# H&M session with the H&M host limits, the rest comes from parser_utils
+CLIENT = HttpClient(HOST_LIMIT, HOST_MAX_LIMIT, HOST_RATE)
+SESSION = CLIENT.session
+make_request = CLIENT.make_request
+init_session = CLIENT.init_session
+loadPhoto = partial(parser_utils.loadPhoto, CLIENT)
+PhotoUploader = partial(parser_utils.PhotoUploader, CLIENT)
+download_images = partial(parser_utils.download_images, CLIENT)
+translate = partial(parser_utils.translate, CLIENT)
+translate_batch = partial(parser_utils.translate_batch, CLIENT)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,1500 @@
+# Brand-independent infrastructure shared by the parsers of all brands.
+# hm_parser/utils.py and cos_parser/utils.py import it, so a process running both brands (see scheduler.py)
+# has one instance of everything here: one limiter per host, one metrics registry, one cache of every kind.
+import requests
+from deep_translator import GoogleTranslator
+from deep_translator.exceptions import TooManyRequests, NotValidPayload, NotValidLength, LanguageNotSupportedException
+import traceback
+import urllib3
+from urllib3.exceptions import InsecureRequestWarning
+import os
+import re
+import sqlite3
+import hashlib
+import zlib
+import uuid
+import socket
+import json
+from collections import Counter, deque
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from requests.exceptions import RequestException
+from time import sleep
+from random import uniform
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from time import time, perf_counter
+
+from PIL import Image
+from io import BytesIO
+import toml
+from pymongo import InsertOne, UpdateOne, ASCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, PyMongoError
+
+CONFIG = toml.load(f'CONFIG.toml')
+BACKOFF_MAX = CONFIG['ParserManager'].get('request_backoff_max', 60)
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+THROTTLE_STATUSES = {429, 503} # the host asks to slow down
+TRANSLATE_URL = 'https://translate.google.com'
+TRANSLATION_CACHE_PATH = CONFIG['ParserManager'].get('translation_cache_path', 'translation_cache.sqlite')
+TRANSLATION_CACHE_SIZE = CONFIG['ParserManager'].get('translation_cache_size', 100000)
+HTTP_CACHE_PATH = CONFIG['ParserManager'].get('http_cache_path', 'http_cache.sqlite')
+HTTP_CACHE_TTL = CONFIG['ParserManager'].get('http_cache_ttl', 0)
+HTTP_CACHE_SIZE = CONFIG['ParserManager'].get('http_cache_size', 10000)
+CHECKPOINT_PATH = CONFIG['ParserManager'].get('checkpoint_path', 'checkpoints.sqlite')
+METRICS_PATH = CONFIG['ParserManager'].get('metrics_path', 'metrics.jsonl')
+METRICS_PORT = CONFIG['ParserManager'].get('metrics_port', 0)
+METRICS_SAMPLES = 10000 # latency samples kept per stage for the quantiles
+TRANSLATE_SEPARATOR = '\n|||\n'
+TRANSLATE_MAX_LENGTH = 4500 # translator accepts up to 5000 characters per request
+IMAGES_PATH = CONFIG['ParserManager'].get('images_path', 'imgs')
+IMAGE_THREAD_COUNT = CONFIG['ParserManager'].get('images_thread_count', 8)
+IMAGE_PROCESS_COUNT = CONFIG['ParserManager'].get('images_process_count', os.cpu_count())
+UPLOAD_THREAD_COUNT = CONFIG['ParserManager'].get('upload_thread_count', 2)
+UPLOAD_QUEUE_SIZE = CONFIG['ParserManager'].get('upload_queue_size', 8)
+UPLOAD_CHUNK_SIZE = 64 * 1024
+BULK_SIZE = CONFIG['Server'].get('bulk_write_size', 100)
+BULK_INTERVAL = CONFIG['Server'].get('bulk_write_interval', 5)
+SHARD_COUNT = CONFIG['ParserManager'].get('update_shard_count', 1)
+SHARD_TIMEOUT = CONFIG['ParserManager'].get('update_shard_timeout', 600)
+
+urllib3.disable_warnings(InsecureRequestWarning) # disable https invalid cert verification warnings
+
+_host_limiters = {}
+_host_limiters_lock = threading.Lock()
+
+
+class HostLimiter:
+    """
+    Limits requests to one host, used as a context manager around every request.
+    A token bucket keeps the rate under rate requests per second (0 - no limit, bursts up to max_limit).
+    The number of simultaneous requests adapts AIMD-style: it starts at limit, grows by one after
+    a window of successful requests up to max_limit and halves when the host throttles.
+    """
+    def __init__(self, limit, max_limit, rate=0):
+        self.limit = float(limit)
+        self.max_limit = max_limit
+        self.rate = rate
+        self.tokens = float(max_limit)
+        self.updated = time()
+        self.active = 0
+        self.successes = 0
+        self.decreased = 0
+        self.paused_until = 0
+        self._cond = threading.Condition()
+    
+    def __enter__(self):
+        with self._cond:
+            while True:
+                now = time()
+                wait = self.paused_until - now
+                if wait <= 0 and self.rate:
+                    self.tokens = min(self.max_limit, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens < 1:
+                        wait = (1 - self.tokens) / self.rate
+                if wait <= 0 and self.active < int(self.limit):
+                    break
+                self._cond.wait(wait if wait > 0 else None)
+            if self.rate:
+                self.tokens -= 1
+            self.active += 1
+        return self
+    
+    def __exit__(self, *exc):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+    
+    def success(self):
+        with self._cond:
+            self.successes += 1
+            if self.successes >= self.limit:
+                self.successes = 0
+                self.limit = min(self.max_limit, self.limit + 1)
+                self._cond.notify_all()
+    
+    def throttled(self, retry_after=None):
+        """The host answered 429/503: halve the concurrency and stop sending until Retry-After passes"""
+        with self._cond:
+            now = time()
+            # the requests that were in flight together are throttled together, halve once for all of them
+            if now - self.decreased > 1:
+                self.limit = max(1.0, self.limit / 2)
+                self.successes = 0
+                self.decreased = now
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+    
+    def tighten(self, max_limit, rate):
+        """Another brand requests the host too: keep the stricter of both limits"""
+        with self._cond:
+            self.max_limit = min(self.max_limit, max_limit)
+            self.limit = min(self.limit, self.max_limit)
+            self.tokens = min(self.tokens, self.max_limit)
+            if rate and (not self.rate or rate < self.rate):
+                self.rate = rate
+
+
+def get_host_limiter(url, limit, max_limit, rate=0):
+    """
+    HostLimiter of the host of url, one per host for the whole process.
+    A host requested with different limits (the translator and the photo upload server serve every brand)
+    keeps the strictest of them.
+    """
+    host = urlparse(url).netloc
+    with _host_limiters_lock:
+        if host not in _host_limiters:
+            _host_limiters[host] = HostLimiter(limit, max_limit, rate)
+        else:
+            _host_limiters[host].tighten(max_limit, rate)
+        return _host_limiters[host]
+
+
+def get_retry_after(response):
+    """Seconds from the Retry-After header (delay or HTTP date), None when it is missing or malformed"""
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt, delay):
+    """Exponential backoff with full jitter: a random wait up to delay * 2^attempt, at most BACKOFF_MAX"""
+    return uniform(0, min(BACKOFF_MAX, delay * 2 ** attempt))
+
+
+class Metrics:
+    """
+    Stage timers, counters and latency quantiles shared by all threads of the process.
+    p50/p95 are taken from the last METRICS_SAMPLES samples of every stage.
+    """
+    def __init__(self, samples=METRICS_SAMPLES):
+        self.samples = samples
+        self.counters = Counter()
+        self.stages = {} # stage -> [count, seconds, recent samples]
+        self._lock = threading.Lock()
+    
+    @contextmanager
+    def timer(self, stage):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, perf_counter() - start)
+    
+    def observe(self, stage, seconds):
+        with self._lock:
+            if stage not in self.stages:
+                self.stages[stage] = [0, 0.0, deque(maxlen=self.samples)]
+            timing = self.stages[stage]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2].append(seconds)
+    
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+    
+    def mark(self):
+        """Current position, summary(mark) covers only what was recorded after it"""
+        with self._lock:
+            return {stage: (count, seconds) for stage, (count, seconds, _) in self.stages.items()}, Counter(self.counters)
+    
+    def summary(self, mark=None):
+        stages_start, counters_start = mark or ({}, Counter())
+        stages = {}
+        with self._lock:
+            for stage, (count, seconds, recent) in self.stages.items():
+                start_count, start_seconds = stages_start.get(stage, (0, 0.0))
+                if count == start_count:
+                    continue
+                recent = sorted(list(recent)[-min(count - start_count, len(recent)):])
+                stages[stage] = {
+                    'count': count - start_count,
+                    'seconds': round(seconds - start_seconds, 3),
+                    'p50': round(quantile(recent, 0.5), 4),
+                    'p95': round(quantile(recent, 0.95), 4),
+                    'max': round(recent[-1], 4),
+                }
+            counters = {name: value - counters_start[name] for name, value in self.counters.items()
+                        if value != counters_start[name]}
+        return {'stages': stages, 'counters': counters}
+    
+    def prometheus(self):
+        """All metrics since the start of the process in the Prometheus text format"""
+        summary = self.summary()
+        lines = ['# TYPE parser_stage_seconds summary']
+        for stage, timing in summary['stages'].items():
+            lines.append(f'parser_stage_seconds{{stage="{stage}",quantile="0.5"}} {timing["p50"]}')
+            lines.append(f'parser_stage_seconds{{stage="{stage}",quantile="0.95"}} {timing["p95"]}')
+            lines.append(f'parser_stage_seconds_sum{{stage="{stage}"}} {timing["seconds"]}')
+            lines.append(f'parser_stage_seconds_count{{stage="{stage}"}} {timing["count"]}')
+        for name, value in summary['counters'].items():
+            lines.append(f'# TYPE parser_{name}_total counter')
+            lines.append(f'parser_{name}_total {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def timed(stage, function, *args):
+    """Calls function(*args) and records its time under stage"""
+    with METRICS.timer(stage):
+        return function(*args)
+
+
+def quantile(values, q):
+    """q-quantile of sorted values (nearest rank)"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+METRICS = Metrics()
+
+
+def report_metrics(run, mark, elapsed, path=METRICS_PATH):
+    """
+    Prints the summary of a run and appends it as a JSON line to METRICS_PATH.
+    Runs that share the process (see scheduler.py) also see each other's samples recorded in the meantime.
+    """
+    summary = METRICS.summary(mark)
+    print(f'Metrics of {run}, {elapsed:.1f} s')
+    print(f'{"stage":16} {"count":>7} {"seconds":>9} {"p50 ms":>8} {"p95 ms":>8} {"max ms":>8}')
+    for stage, timing in sorted(summary['stages'].items(), key=lambda item: -item[1]['seconds']):
+        print(f'{stage:16} {timing["count"]:7} {timing["seconds"]:9.2f} {timing["p50"] * 1000:8.1f} '
+              f'{timing["p95"] * 1000:8.1f} {timing["max"] * 1000:8.1f}')
+    for name, value in sorted(summary['counters'].items()):
+        print(f'{name}: {value}')
+    
+    if path:
+        try:
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'run': run, 'time': time(), 'elapsed': round(elapsed, 3), **summary},
+                                   ensure_ascii=False) + '\n')
+        except OSError as e:
+            print(f"Error: {e}")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = METRICS.prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, *args):
+        pass
+
+
+_metrics_server = None
+_metrics_server_lock = threading.Lock()
+
+
+def serve_metrics(port=METRICS_PORT):
+    """Serves METRICS in the Prometheus format on localhost:port from a daemon thread, once per process"""
+    global _metrics_server
+    with _metrics_server_lock:
+        if _metrics_server is not None or not port:
+            return
+        try:
+            _metrics_server = ThreadingHTTPServer(('127.0.0.1', port), _MetricsHandler)
+        except OSError as e:
+            print(f"Error: metrics port {port}: {e}")
+            return
+        threading.Thread(target=_metrics_server.serve_forever, daemon=True).start()
+
+
+class HttpClient:
+    """
+    Session and host limits of one brand. Every brand sends its requests with its own headers and cookies
+    through its own keep-alive pool of up to host_max_limit connections per host,
+    the limiter of a host is shared by all brands (see get_host_limiter).
+    """
+    def __init__(self, host_limit, host_max_limit, host_rate=0):
+        self.host_limit = host_limit
+        self.host_max_limit = host_max_limit
+        self.host_rate = host_rate
+        self._limiters = {} # host -> HostLimiter, registered with the limits of this brand once per host
+        
+        # keep-alive connections are reused between requests; requests per host never exceed host_max_limit
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=host_max_limit, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+    
+    def init_session(self, headers=None, cookies=None, domain=''):
+        """Sets headers and cookies sent with every request of the session"""
+        if headers:
+            self.session.headers.update(headers)
+        if cookies:
+            for name, value in cookies.items():
+                self.session.cookies.set(name, value, domain=domain)
+        return self.session
+    
+    def get_host_limiter(self, url):
+        host = urlparse(url).netloc
+        if host not in self._limiters:
+            self._limiters[host] = get_host_limiter(url, self.host_limit, self.host_max_limit, self.host_rate)
+        return self._limiters[host]
+    
+    def make_request(self, url, method='get', headers=None, cookies=None, files=None, data=None, retries=2, delay=1, cache=False, stream=False):
+        """
+        :cache - send a GET through the HTTP cache: a fresh response is read from disk,
+                 a stale one is revalidated with a conditional request
+        :stream - return as soon as the headers arrive, the body is read by the caller (see search_stream)
+        """
+        cached = None
+        if cache and method != 'post':
+            http_cache = get_http_cache()
+            cached = http_cache.get(url)
+            if cached is not None:
+                response, fresh, validators = cached
+                if fresh:
+                    return response
+                headers = {**(headers or {}), **validators}
+        
+        limiter = self.get_host_limiter(url)
+        for attempt in range(retries + 1):
+            try:
+                if hasattr(data, 'seek'):
+                    data.seek(0) # a retried streaming body is sent from the start
+                METRICS.count('requests')
+                with limiter, METRICS.timer('request'):
+                    if method == 'post':
+                        response = self.session.post(url, headers=headers, cookies=cookies, files=files, data=data, verify=False)
+                    else:
+                        response = self.session.get(url, headers=headers, cookies=cookies, stream=stream)
+                if cached is not None and response.status_code == 304:
+                    http_cache.touch(url)
+                    return cached[0]
+                response.raise_for_status()  # Бросает исключение для 4xx и 5xx кодов ответа
+                limiter.success()
+                if not stream:
+                    METRICS.count('request_bytes', len(response.content))
+                if cache and method != 'post':
+                    http_cache.put(url, response)
+                return response
+            except RequestException as e:
+                print(f"Error: {e}")
+                status = e.response.status_code if e.response is not None else None
+                if e.response is not None:
+                    e.response.close()
+                if status is not None and status not in RETRY_STATUSES:
+                    METRICS.count('request_errors')
+                    return None # 404 and other client errors do not change on retry
+                
+                wait = backoff(attempt, delay)
+                if status in THROTTLE_STATUSES:
+                    retry_after = get_retry_after(e.response)
+                    METRICS.count('request_throttled')
+                    if retry_after is not None and retry_after > BACKOFF_MAX:
+                        # the request is dropped, the host is not paused for every other thread that long
+                        print(f"Retry-After {retry_after:.0f} seconds is too long, skip")
+                        limiter.throttled()
+                        METRICS.count('request_errors')
+                        return None
+                    limiter.throttled(retry_after)
+                    wait = max(wait, retry_after or 0)
+                if attempt < retries:
+                    METRICS.count('request_retries')
+                    print(f"Retrying in {wait:.1f} seconds...")
+                    sleep(wait)
+        METRICS.count('request_errors')
+        return None  # Если все попытки завершились неудачей
+
+
+def loadPhoto(client, brand, article, color, imageFiles):
+    """
+    :client - HttpClient of the brand the photos are uploaded for
+    :imageFiles - list of (filename, content hash) pairs from download_images
+    Galleries whose images were already uploaded unchanged are not sent again.
+    """
+    gallery = '{}_{}_{}'.format(brand, article, color.replace('/','_'))
+    upload_url = 'https://83.147.245.51:5000/upload_imgs/{}'.format(gallery)
+    
+    store = get_image_store()
+    digests = [digest for _, digest in imageFiles]
+    if store.get_uploaded(gallery) == digests:
+        return True
+
+    try:
+        with MultipartStream([(filename, store.object_path(digest)) for filename, digest in imageFiles]) as body, \
+                METRICS.timer('upload'):
+            METRICS.count('upload_bytes', len(body))
+            response = client.make_request(upload_url, 'post', headers={'Content-Type': body.content_type}, data=body).text
+        if response.lower() == 'success':
+            store.set_uploaded(gallery, digests)
+            return True
+        raise Exception(f'Error! Response: {response}')
+    except Exception as e:
+        print(e)
+        return False
+
+
+class TranslationCache:
+    """
+    Persistent SQLite cache of translations keyed by source text and target language.
+    When the cache grows over max_size the least recently used translations are evicted.
+    """
+    def __init__(self, path=TRANSLATION_CACHE_PATH, max_size=TRANSLATION_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS translations ('
+            'text TEXT, target TEXT, translated TEXT, used REAL, PRIMARY KEY (text, target))'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS translations_used ON translations (used)')
+        self._conn.commit()
+        self._size = self._conn.execute('SELECT COUNT(*) FROM translations').fetchone()[0]
+    
+    def get(self, text, target):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT translated FROM translations WHERE text = ? AND target = ?', (text, target)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                METRICS.count('translation_cache_misses')
+                return None
+            self.hits += 1
+            METRICS.count('translation_cache_hits')
+            self._conn.execute('UPDATE translations SET used = ? WHERE text = ? AND target = ?', (time(), text, target))
+            self._conn.commit()
+            return row[0]
+    
+    def set(self, text, target, translated):
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT OR IGNORE INTO translations (text, target, translated, used) VALUES (?, ?, ?, ?)',
+                (text, target, translated, time())
+            )
+            self._size += cursor.rowcount
+            if self._size > self.max_size:
+                # evict a tenth of the cache at once so eviction does not run on every insert
+                evicted = self._size - self.max_size + self.max_size // 10
+                self._conn.execute(
+                    'DELETE FROM translations WHERE rowid IN (SELECT rowid FROM translations ORDER BY used LIMIT ?)',
+                    (evicted,)
+                )
+                self._size = self._conn.execute('SELECT COUNT(*) FROM translations').fetchone()[0]
+            self._conn.commit()
+
+
+_translation_cache = None
+_translation_cache_lock = threading.Lock()
+
+
+def get_translation_cache():
+    global _translation_cache
+    with _translation_cache_lock:
+        if _translation_cache is None:
+            _translation_cache = TranslationCache()
+        return _translation_cache
+
+
+def translate(client, text, retries=2, delay=1, target='ru'):
+    cache = get_translation_cache()
+    translated = cache.get(text, target)
+    if translated is not None:
+        return translated
+    
+    translated = _google_translate(client, text, target, retries, delay)
+    if translated is not None:
+        cache.set(text, target, translated)
+    return translated
+
+
+def translate_batch(client, texts, retries=2, delay=1, target='ru'):
+    """
+    Translates a list of strings with as few translator requests as possible.
+    Texts missing from the cache are joined with TRANSLATE_SEPARATOR into requests
+    of up to TRANSLATE_MAX_LENGTH characters and the result is split back.
+    """
+    cache = get_translation_cache()
+    translations = {}
+    missing = {}
+    for text in texts:
+        if text in translations or text in missing:
+            continue
+        translated = cache.get(text, target)
+        if translated is None:
+            missing[text] = None
+        else:
+            translations[text] = translated
+    
+    chunks = []
+    length = 0
+    for text in missing:
+        if not chunks or length + len(text) > TRANSLATE_MAX_LENGTH:
+            chunks.append([])
+            length = 0
+        chunks[-1].append(text)
+        length += len(text) + len(TRANSLATE_SEPARATOR)
+    
+    for chunk in chunks:
+        translated = _google_translate(client, TRANSLATE_SEPARATOR.join(chunk), target, retries, delay)
+        parts = translated.split(TRANSLATE_SEPARATOR.strip()) if translated else []
+        if len(parts) != len(chunk):
+            # separator was lost in translation, fall back to one request per text
+            parts = [_google_translate(client, text, target, retries, delay) for text in chunk]
+        for text, part in zip(chunk, parts):
+            if part is not None:
+                part = part.strip()
+                cache.set(text, target, part)
+            translations[text] = part
+    
+    return [translations[text] for text in texts]
+
+
+def _google_translate(client, text, target, retries, delay):
+    limiter = client.get_host_limiter(TRANSLATE_URL)
+    for attempt in range(retries + 1):
+        try:
+            with limiter, METRICS.timer('translate_request'):
+                translated = GoogleTranslator(source='auto', target=target).translate(text)
+            limiter.success()
+            return translated
+        except (NotValidPayload, NotValidLength, LanguageNotSupportedException) as e:
+            print(f"Error: {e}")
+            return None # the same text fails the same way again
+        except Exception as e:
+            print(f"Error: {e}")
+            if isinstance(e, TooManyRequests):
+                limiter.throttled()
+                METRICS.count('translate_throttled')
+            if attempt < retries:
+                METRICS.count('translate_retries')
+                wait = backoff(attempt, delay)
+                print(f"Retrying in {wait:.1f} seconds...")
+                sleep(wait)
+    return None
+
+
+def encode_jpeg(content):
+    """Re-encodes downloaded image bytes to JPEG, runs in the image process pool"""
+    image = Image.open(BytesIO(content))
+    
+    buffer = BytesIO()
+    image.save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+_image_threads = None
+_image_processes = None
+_image_pools_lock = threading.Lock()
+
+
+def get_image_pools():
+    global _image_threads, _image_processes
+    with _image_pools_lock:
+        if _image_threads is None:
+            _image_threads = ThreadPoolExecutor(max_workers=IMAGE_THREAD_COUNT)
+            _image_processes = ProcessPoolExecutor(max_workers=IMAGE_PROCESS_COUNT)
+        return _image_threads, _image_processes
+
+
+_parse_pools = {}
+
+
+def get_parse_pool(brand, process_count):
+    """Pool of product page parse processes of brand, shared by all its categories run in this process"""
+    with _image_pools_lock:
+        if brand not in _parse_pools:
+            _parse_pools[brand] = ProcessPoolExecutor(max_workers=process_count)
+        return _parse_pools[brand]
+
+
+def download_images(client, urls, basename):
+    """
+    Downloads all images concurrently and re-encodes them to JPEG in a process pool.
+    Images whose URL is already in the image store are not downloaded again.
+    Returns (filename, content hash) pairs for the available images, named {basename}_{index}.jpg
+    :client - HttpClient of the brand the images are downloaded for
+    """
+    threads, processes = get_image_pools()
+    store = get_image_store()
+    
+    digests = [store.get_digest(url) for url in urls]
+    missing = [i for i, digest in enumerate(digests) if digest is None]
+    METRICS.count('image_store_hits', len(urls) - len(missing))
+    
+    encoded = []
+    for i, response in zip(missing, threads.map(client.make_request, [urls[i] for i in missing])):
+        if response is None or response.status_code != 200:
+            print("Error downloading image. URL:", urls[i])
+            continue
+        METRICS.count('image_bytes', len(response.content))
+        encoded.append((i, processes.submit(encode_jpeg, response.content)))
+    
+    for i, future in encoded:
+        try:
+            digests[i] = store.put(urls[i], future.result())
+        except:
+            traceback.print_exc()
+            print("Error downloading image. URL:", urls[i])
+    
+    return [(f'{basename}_{i}.jpg', digest) for i, digest in enumerate(digests) if digest is not None]
+
+
+class MultipartStream:
+    """
+    File-like multipart/form-data body that reads the files part by part while it is sent.
+    Only one file is open at a time and it is closed as soon as it has been read.
+    """
+    def __init__(self, files):
+        """
+        :files - list of (filename, path) pairs, every file is sent as a field named after the file
+        """
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={self.boundary}'
+        
+        self._parts = []
+        for filename, path in files:
+            header = (
+                f'--{self.boundary}\r\n'
+                f'Content-Disposition: form-data; name="{filename}"; filename="{filename}"\r\n\r\n'
+            ).encode()
+            self._parts.append((header, path))
+        self._footer = f'--{self.boundary}--\r\n'.encode()
+        self.len = sum(len(header) + os.path.getsize(path) + 2 for header, path in self._parts) + len(self._footer)
+        
+        self._chunks = None
+        self._buffer = b''
+        self._file = None
+        self.seek(0)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def __len__(self):
+        return self.len
+    
+    def _iter_chunks(self):
+        for header, path in self._parts:
+            yield header
+            self._file = open(path, 'rb')
+            try:
+                while True:
+                    chunk = self._file.read(UPLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                self._file.close()
+                self._file = None
+            yield b'\r\n'
+        yield self._footer
+    
+    def seek(self, offset, whence=0):
+        if offset != 0 or whence != 0:
+            raise OSError('MultipartStream can only be rewound to the start')
+        self.close()
+        self._chunks = self._iter_chunks()
+        self._buffer = b''
+        return 0
+    
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+    
+    def close(self):
+        if self._chunks is not None:
+            self._chunks.close() # closes the open file through the generator's finally
+            self._chunks = None
+
+
+class PhotoUploader:
+    """
+    Uploads galleries with loadPhoto in the background while parsing goes on.
+    At most UPLOAD_THREAD_COUNT uploads run at once, submit blocks when
+    UPLOAD_QUEUE_SIZE uploads are already waiting.
+    """
+    def __init__(self, client, thread_count=UPLOAD_THREAD_COUNT, queue_size=UPLOAD_QUEUE_SIZE):
+        self.client = client
+        self._executor = ThreadPoolExecutor(max_workers=thread_count)
+        self._slots = threading.BoundedSemaphore(thread_count + queue_size)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def submit(self, brand, article, color, imageFiles):
+        self._slots.acquire()
+        future = self._executor.submit(loadPhoto, self.client, brand, article, color, imageFiles)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+    
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+class ImageStore:
+    """
+    Persistent content-addressed store of encoded images under IMAGES_PATH.
+    Remembers the content hash of every downloaded source URL and the hashes
+    uploaded for every {brand}_{article}_{color} gallery.
+    """
+    def __init__(self, path=IMAGES_PATH):
+        self.path = path
+        os.makedirs(os.path.join(path, 'objects'), exist_ok=True)
+        
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(path, 'index.sqlite'), timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS images (url TEXT PRIMARY KEY, digest TEXT)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS uploads (gallery TEXT PRIMARY KEY, digests TEXT)')
+        self._conn.commit()
+    
+    def object_path(self, digest):
+        return os.path.join(self.path, 'objects', digest + '.jpg')
+    
+    def get_digest(self, url):
+        with self._lock:
+            row = self._conn.execute('SELECT digest FROM images WHERE url = ?', (url,)).fetchone()
+        if row is None or not os.path.exists(self.object_path(row[0])):
+            return None
+        return row[0]
+    
+    def put(self, url, content):
+        digest = hashlib.sha256(content).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            tmp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO images (url, digest) VALUES (?, ?)', (url, digest))
+            self._conn.commit()
+        return digest
+    
+    def get_uploaded(self, gallery):
+        with self._lock:
+            row = self._conn.execute('SELECT digests FROM uploads WHERE gallery = ?', (gallery,)).fetchone()
+        return row[0].split(',') if row and row[0] else None
+    
+    def set_uploaded(self, gallery, digests):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO uploads (gallery, digests) VALUES (?, ?)', (gallery, ','.join(digests)))
+            self._conn.commit()
+
+
+_image_store = None
+
+
+def get_image_store():
+    global _image_store
+    with _image_pools_lock:
+        if _image_store is None:
+            _image_store = ImageStore()
+        return _image_store
+
+
+class HttpCache:
+    """
+    Persistent SQLite cache of GET responses with their ETag and Last-Modified validators.
+    A response younger than ttl seconds is served without a request, an older one is revalidated
+    with a conditional request and served from disk on 304 Not Modified.
+    When the cache grows over max_size the least recently used responses are evicted.
+    """
+    def __init__(self, path=HTTP_CACHE_PATH, ttl=HTTP_CACHE_TTL, max_size=HTTP_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, encoding TEXT, content BLOB, fetched REAL, used REAL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+        self._conn.commit()
+        self._size = self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+    
+    def get(self, url):
+        """
+        Returns (cached response, fresh, conditional request headers) or None
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT etag, last_modified, encoding, content, fetched FROM responses WHERE url = ?', (url,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute('UPDATE responses SET used = ? WHERE url = ?', (time(), url))
+            self._conn.commit()
+        etag, last_modified, encoding, content, fetched = row
+        
+        validators = {}
+        if etag:
+            validators['If-None-Match'] = etag
+        if last_modified:
+            validators['If-Modified-Since'] = last_modified
+        fresh = time() - fetched < self.ttl
+        if fresh:
+            self.hits += 1
+            METRICS.count('http_cache_hits')
+        return self.response(url, encoding, zlib.decompress(content)), fresh, validators
+    
+    def put(self, url, response):
+        self.misses += 1
+        METRICS.count('http_cache_misses')
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if 'no-store' in response.headers.get('Cache-Control', '') or not (etag or last_modified or self.ttl):
+            return
+        content = zlib.compress(response.content, 1)
+        with self._lock:
+            if self._conn.execute('SELECT 1 FROM responses WHERE url = ?', (url,)).fetchone() is None:
+                self._size += 1
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses (url, etag, last_modified, encoding, content, fetched, used) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (url, etag, last_modified, response.encoding, content, time(), time())
+            )
+            if self._size > self.max_size:
+                # evict a tenth of the cache at once so eviction does not run on every insert
+                evicted = self._size - self.max_size + self.max_size // 10
+                self._conn.execute(
+                    'DELETE FROM responses WHERE rowid IN (SELECT rowid FROM responses ORDER BY used LIMIT ?)',
+                    (evicted,)
+                )
+                self._size = self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            self._conn.commit()
+    
+    def touch(self, url):
+        # the server answered 304, the stored response is fresh again
+        self.revalidated += 1
+        METRICS.count('http_cache_revalidated')
+        with self._lock:
+            self._conn.execute('UPDATE responses SET fetched = ? WHERE url = ?', (time(), url))
+            self._conn.commit()
+    
+    @staticmethod
+    def response(url, encoding, content):
+        response = requests.Response()
+        response.url = url
+        response.status_code = 200
+        response.encoding = encoding
+        response._content = content
+        return response
+
+
+_http_cache = None
+_http_cache_lock = threading.Lock()
+
+
+def get_http_cache():
+    global _http_cache
+    with _http_cache_lock:
+        if _http_cache is None:
+            _http_cache = HttpCache()
+        return _http_cache
+
+
+def search_stream(response, pattern, chunk_size=16 * 1024, overlap=4096):
+    """
+    Reads a streamed response chunk by chunk until pattern matches and closes it without reading the rest.
+    Only the last overlap characters are kept between chunks, a match must be shorter than that.
+    Returns the match or None.
+    """
+    if response.encoding is None:
+        response.encoding = 'utf-8'
+    text = ''
+    try:
+        for chunk in response.iter_content(chunk_size=chunk_size, decode_unicode=True):
+            text = text[-overlap:] + chunk
+            match = pattern.search(text)
+            if match:
+                return match
+    finally:
+        response.close()
+    return None
+
+
+def iter_completed(executor, jobs, limit):
+    """
+    Submits jobs to the executor lazily with at most limit of them in flight
+    and yields (key, future) pairs in completion order.
+    :jobs - iterable of (key, function, *args) tuples
+    """
+    pending = {}
+    for key, function, *args in jobs:
+        if len(pending) >= limit:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future
+        pending[executor.submit(function, *args)] = key
+    for future in as_completed(pending):
+        yield pending[future], future
+
+
+def iter_stage(executor, function, items, limit):
+    """
+    One stage of a streaming pipeline. Pulls (key, value) items lazily from the previous stage,
+    runs function(key, value) on the executor with at most limit calls in flight
+    and yields (key, result) in completion order. Failed items and None results are dropped.
+    """
+    jobs = ((key, function, key, value) for key, value in items)
+    for key, future in iter_completed(executor, jobs, limit):
+        try:
+            result = future.result()
+        except Exception:
+            traceback.print_exc()
+            print("Skip URL:", key)
+            continue
+        if result is not None:
+            yield key, result
+
+
+class BulkWriter:
+    """
+    Buffers inserts and updates and sends them to the collection as unordered bulk_write batches.
+    A batch is flushed when it reaches BULK_SIZE operations, every BULK_INTERVAL seconds
+    and when the writer is closed.
+    :on_insert - called with the list of documents of every batch whose insert succeeded
+    """
+    def __init__(self, collection, batch_size=BULK_SIZE, interval=BULK_INTERVAL, on_insert=None):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.interval = interval
+        self.on_insert = on_insert
+        
+        self.inserted_count = 0
+        self.modified_count = 0
+        
+        self._ops = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._timer = threading.Thread(target=self._flush_periodically, daemon=True)
+    
+    def __enter__(self):
+        self._timer.start()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def insert(self, document):
+        self._add(InsertOne(document), document)
+    
+    def update(self, filter_criteria, update):
+        self._add(UpdateOne(filter_criteria, update))
+    
+    def flush(self):
+        with self._lock:
+            ops, self._ops = self._ops, []
+            if ops:
+                self._write(ops)
+    
+    def close(self):
+        self._stop.set()
+        if self._timer.is_alive():
+            self._timer.join()
+        self.flush()
+    
+    def _add(self, op, document=None):
+        with self._lock:
+            self._ops.append((op, document))
+            if len(self._ops) < self.batch_size:
+                return
+            ops, self._ops = self._ops, []
+            self._write(ops)
+    
+    def _flush_periodically(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+    
+    def _write(self, ops):
+        failed = set()
+        METRICS.count('mongo_ops', len(ops))
+        try:
+            with METRICS.timer('mongo_write'):
+                result = self.collection.bulk_write([op for op, _ in ops], ordered=False)
+            self.inserted_count += result.inserted_count
+            self.modified_count += result.modified_count
+        except BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                failed.add(error['index'])
+                print(error['errmsg'])
+            self.inserted_count += e.details['nInserted']
+            self.modified_count += e.details['nModified']
+        except Exception as e:
+            print(e)
+            return
+        
+        inserted = [document for i, (_, document) in enumerate(ops) if document is not None and i not in failed]
+        for document in inserted:
+            print("Inserted document ID:", document['_id'])
+        if inserted and self.on_insert:
+            self.on_insert(inserted)
+
+
+class Checkpoint:
+    """
+    Progress of one (brand, category, mode) run in the CHECKPOINT_PATH SQLite file.
+    Records the pipeline stage every article has reached: fetched, parsed (queued for writing) or written.
+    A run that did not finish is resumed by the next run with the same name, a finished run starts over.
+    """
+    def __init__(self, run, path=CHECKPOINT_PATH):
+        self.run = run
+        
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS runs (run TEXT PRIMARY KEY, finished INTEGER, started REAL)')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS items (run TEXT, article TEXT, stage TEXT, PRIMARY KEY (run, article))'
+        )
+        row = self._conn.execute('SELECT finished FROM runs WHERE run = ?', (run,)).fetchone()
+        self.resumed = row is not None and not row[0]
+        if not self.resumed:
+            self._conn.execute('DELETE FROM items WHERE run = ?', (run,))
+            self._conn.execute('INSERT OR REPLACE INTO runs (run, finished, started) VALUES (?, 0, ?)', (run, time()))
+        self._conn.commit()
+    
+    def get(self, article):
+        with self._lock:
+            row = self._conn.execute('SELECT stage FROM items WHERE run = ? AND article = ?', (self.run, article)).fetchone()
+        return row[0] if row else None
+    
+    def mark(self, articles, stage):
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO items (run, article, stage) VALUES (?, ?, ?)',
+                [(self.run, article, stage) for article in articles]
+            )
+            self._conn.commit()
+    
+    def count(self, stage):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM items WHERE run = ? AND stage = ?', (self.run, stage)).fetchone()[0]
+    
+    def is_written(self, article, collection, filter_criteria):
+        """
+        :filter_criteria - filter of the documents of the brand
+        """
+        stage = self.get(article)
+        if stage == 'parsed':
+            # queued for writing when the run stopped, the collection tells whether the insert went through
+            return collection.find_one({'article': article, **filter_criteria}, {'_id': True}) is not None
+        return stage == 'written'
+    
+    def mark_written(self, documents):
+        """on_insert callback of the BulkWriter of the run"""
+        self.mark([document['article'] for document in documents], 'written')
+    
+    def finish(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM items WHERE run = ?', (self.run,))
+            self._conn.execute('UPDATE runs SET finished = 1 WHERE run = ?', (self.run,))
+            self._conn.commit()
+    
+    def close(self):
+        self._conn.close()
+
+
+def ensure_indexes(collection):
+    """Creates the (brand, article) index behind the update cursors and the update filters"""
+    try:
+        collection.create_index([('brand', ASCENDING), ('article', ASCENDING)])
+    except PyMongoError as e:
+        print(f"Error: {e}")
+
+
+class ShardPlan:
+    """
+    Splits the articles matched by filter_criteria into shard_count article ranges of about the same size,
+    stored in the update_shards collection next to the products.
+    Workers in any number of processes or machines claim pending ranges one at a time and save
+    the article they have to resume from. A range is claimed again when its worker stopped saving
+    for timeout seconds, or at once when that worker was a process of this host that has exited.
+    A new plan is made once every range of the previous one is done.
+    """
+    def __init__(self, collection, name, filter_criteria, shard_count=SHARD_COUNT, timeout=SHARD_TIMEOUT):
+        self.collection = collection
+        self.shards = collection.database['update_shards']
+        self.name = name
+        self.filter_criteria = filter_criteria
+        self.shard_count = shard_count
+        self.timeout = timeout
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self.save_interval = BULK_SIZE
+    
+    def plan(self):
+        statuses = [shard['status'] for shard in self.shards.find({'plan': self.name}, {'status': True})]
+        if statuses and any(status != 'done' for status in statuses):
+            return
+        self.shards.delete_many({'plan': self.name, 'status': 'done'})
+        
+        bounds = [None] + self.bounds() + [None]
+        shards = [{'_id': f'{self.name}:{i}', 'plan': self.name, 'shard': i, 'lo': lo, 'hi': hi,
+                   'resume': None, 'status': 'pending', 'host': None, 'pid': None, 'heartbeat': 0}
+                  for i, (lo, hi) in enumerate(zip(bounds, bounds[1:]))]
+        try:
+            self.shards.insert_many(shards, ordered=True)
+        except BulkWriteError:
+            pass # another worker has made the plan first
+    
+    def bounds(self):
+        # boundaries at every 1/shard_count of the articles, read from the (brand, article) index
+        count = self.collection.count_documents(self.filter_criteria)
+        bounds = []
+        for i in range(1, self.shard_count):
+            document = next(self.collection.find(self.filter_criteria, {'_id': False, 'article': True})
+                            .sort('article', ASCENDING).skip(count * i // self.shard_count).limit(1), None)
+            if document and (not bounds or document['article'] > bounds[-1]):
+                bounds.append(document['article'])
+        return bounds
+    
+    def claim(self):
+        self.release_exited()
+        now = time()
+        return self.shards.find_one_and_update(
+            {'plan': self.name, '$or': [{'status': 'pending'},
+                                        {'status': 'running', 'heartbeat': {'$lt': now - self.timeout}},
+                                        {'status': 'running', 'host': self.host, 'pid': self.pid}]},
+            {'$set': {'status': 'running', 'host': self.host, 'pid': self.pid, 'heartbeat': now}},
+            sort=[('shard', ASCENDING)], return_document=ReturnDocument.AFTER
+        )
+    
+    def release_exited(self):
+        # signal 0 only checks that the process exists, on Windows it would be CTRL_C_EVENT
+        if os.name == 'nt':
+            return
+        for shard in self.shards.find({'plan': self.name, 'status': 'running', 'host': self.host}, {'pid': True}):
+            try:
+                os.kill(shard['pid'], 0)
+            except ProcessLookupError:
+                self.shards.update_one({'_id': shard['_id'], 'host': self.host, 'pid': shard['pid']},
+                                       {'$set': {'status': 'pending'}})
+            except OSError:
+                pass
+    
+    def range_filter(self, shard):
+        articles = {}
+        if shard['resume'] or shard['lo']:
+            articles['$gte'] = shard['resume'] or shard['lo']
+        if shard['hi']:
+            articles['$lt'] = shard['hi']
+        return {**self.filter_criteria, 'article': articles} if articles else dict(self.filter_criteria)
+    
+    def save(self, shard, resume):
+        shard['resume'] = resume
+        self.shards.update_one({'_id': shard['_id'], 'host': self.host, 'pid': self.pid},
+                               {'$set': {'resume': resume, 'heartbeat': time()}})
+    
+    def finish(self, shard):
+        self.shards.update_one({'_id': shard['_id'], 'host': self.host, 'pid': self.pid},
+                               {'$set': {'status': 'done', 'heartbeat': time()}})
+
+
+class Updater:
+    """
+    Availability and price refresh of the stored products of one brand.
+    :update_document - function(document) returning (filter, changed fields) or None when the update failed,
+                       called with the projection of every stored document
+    run walks the articles of the ShardPlan concurrently, apply queues one result (the incremental parser
+    mode refreshes its existing articles with it); both count the articles as failed, unchanged or changed.
+    """
+    def __init__(self, collection, update_document, projection, thread_count=1):
+        self.collection = collection
+        self.update_document = update_document
+        self.projection = projection
+        self.thread_count = thread_count
+        self.counts = Counter()
+        self._lock = threading.Lock()
+    
+    def run(self, filter_criteria, plan_name):
+        """
+        Updates the documents matched by filter_criteria, returns the BulkWriter the updates went through
+        :plan_name - name of the ShardPlan shared with the other update workers of the brand
+        """
+        return asyncio.run(self._run(filter_criteria, plan_name))
+    
+    async def _run(self, filter_criteria, plan_name):
+        ensure_indexes(self.collection)
+        # article ranges shared with the other update workers, every range resumes from its saved article
+        shards = ShardPlan(self.collection, plan_name, filter_criteria)
+        
+        loop = asyncio.get_running_loop()
+        # one thread per request in flight plus one for the cursor
+        executor = ThreadPoolExecutor(max_workers=self.thread_count + 1)
+        semaphore = asyncio.Semaphore(self.thread_count)
+        with BulkWriter(self.collection) as writer:
+            try:
+                await loop.run_in_executor(executor, shards.plan)
+                while True:
+                    shard = await loop.run_in_executor(executor, shards.claim)
+                    if shard is None:
+                        break
+                    print('Update articles from', shard['resume'] or shard['lo'], 'to', shard['hi'])
+                    await self._update_shard(shard, shards, loop, executor, semaphore, writer)
+            finally:
+                executor.shutdown()
+        return writer
+    
+    async def _update_shard(self, shard, shards, loop, executor, semaphore, writer):
+        cursor = self.collection.find(shards.range_filter(shard), self.projection).sort('article', ASCENDING)
+        tasks = set()
+        # articles being updated, the saved progress never passes the smallest of them
+        pending = set()
+        dispatched = 0
+        try:
+            while True:
+                await semaphore.acquire()
+                document = await loop.run_in_executor(executor, next, cursor, None)
+                if document is None:
+                    semaphore.release()
+                    break
+                article = document['article']
+                pending.add(article)
+                task = asyncio.create_task(self._update(document, loop, executor, semaphore, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _, article=article: pending.discard(article))
+                
+                dispatched += 1
+                if dispatched % shards.save_interval == 0:
+                    resume = min(pending)
+                    # updates of the articles before resume are written before the progress is saved
+                    await loop.run_in_executor(executor, writer.flush)
+                    await loop.run_in_executor(executor, shards.save, shard, resume)
+        finally:
+            cursor.close()
+            # updates already started are finished and queued even when the cursor fails
+            await asyncio.gather(*tasks, return_exceptions=True)
+        await loop.run_in_executor(executor, writer.flush)
+        await loop.run_in_executor(executor, shards.finish, shard)
+    
+    async def _update(self, document, loop, executor, semaphore, writer):
+        try:
+            try:
+                update = await loop.run_in_executor(executor, timed, 'update', self.update_document, document)
+            except Exception:
+                traceback.print_exc()
+                update = None
+            # a full batch is written by the thread that adds the last operation
+            await loop.run_in_executor(executor, self.apply, writer, update)
+        finally:
+            semaphore.release()
+    
+    def refresh(self, writer, filter_criteria):
+        """Updates the stored document matched by filter_criteria, a missing one counts as failed"""
+        document = self.collection.find_one(filter_criteria, self.projection)
+        self.apply(writer, timed('update', self.update_document, document) if document else None)
+    
+    def apply(self, writer, update):
+        """
+        Queues the changed fields of an update_document result
+        and counts the article as failed, unchanged or changed
+        """
+        if update is None:
+            outcome = 'failed'
+        elif not update[1]:
+            outcome = 'unchanged'
+        else:
+            filter_criteria, new_record = update
+            writer.update(filter_criteria, {'$set': new_record})
+            outcome = 'changed'
+        with self._lock:
+            self.counts[outcome] += 1
+        METRICS.count(f'update_{outcome}')
+    
+    def print_counts(self):
+        print("Unchanged:", self.counts['unchanged'], "changed:", self.counts['changed'],
+              "failed:", self.counts['failed'])
+
+
+_JS_TOKEN = re.compile(r"""
+    \s*(?:(?://[^\n]*|/\*.*?\*/)\s*)*
+    (?:
+        (?P<string>"[^"\\\n]*(?:\\.[^"\\\n]*)*"|'[^'\\\n]*(?:\\.[^'\\\n]*)*')
+        |(?P<number>(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)
+        |(?P<name>[A-Za-z_$][\w$]*)
+        |(?P<punct>[{}\[\]:,?+\-().!])
+    )
+""", re.VERBOSE | re.DOTALL)
+_JS_ESCAPE = re.compile(r'\\(u[0-9a-fA-F]{4}|x[0-9a-fA-F]{2}|.)', re.DOTALL)
+_JS_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f', 'v': '\v', '0': '\0'}
+_JS_CONSTANTS = {'true': True, 'false': False, 'null': None, 'undefined': None}
+
+
+def _js_unescape(match):
+    escape = match.group(1)
+    if escape[0] in 'ux' and len(escape) > 1:
+        return chr(int(escape[1:], 16))
+    return _JS_ESCAPES.get(escape, escape)
+
+
+class _JSObjectParser:
+    """
+    Single pass recursive descent parser for the JS object literals embedded in product pages.
+    Besides JSON it accepts single quoted strings, unquoted keys, trailing commas and comments.
+    Expressions are reduced to plain values: `cond ? a : b` gives a (the desktop variant),
+    string concatenation is joined and anything else (variables, calls, member access) gives None.
+    """
+    def __init__(self, text, pos):
+        self.text = text
+        self.pos = pos
+        self._token = None
+    
+    def peek(self):
+        if self._token is None:
+            match = _JS_TOKEN.match(self.text, self.pos)
+            if match is None:
+                # not part of an expression, e.g. the `;` after the literal
+                self._token = ('invalid', self.text[self.pos:self.pos + 30], self.pos)
+            else:
+                self._token = (match.lastgroup, match.group(match.lastgroup), match.end())
+        return self._token
+    
+    def next(self):
+        token = self.peek()
+        self.pos = token[2]
+        self._token = None
+        return token
+    
+    def expect(self, punct):
+        kind, value, _ = self.next()
+        if kind != 'punct' or value != punct:
+            raise ValueError(f'Expected {punct!r} before position {self.pos}, got {value!r}')
+    
+    def accept(self, punct):
+        kind, value, _ = self.peek()
+        if kind == 'punct' and value == punct:
+            self.next()
+            return True
+        return False
+    
+    def parse_value(self):
+        value = self.parse_sum()
+        if self.accept('?'):
+            value = self.parse_value()
+            self.expect(':')
+            self.parse_value()
+        return value
+    
+    def parse_sum(self):
+        value = self.parse_postfix()
+        while self.accept('+'):
+            right = self.parse_postfix()
+            if isinstance(value, str) and isinstance(right, str):
+                value += right
+            else:
+                value = None
+        return value
+    
+    def parse_postfix(self):
+        value = self.parse_primary()
+        while True:
+            if self.accept('.'):
+                self.next()
+                value = None
+            elif self.accept('('):
+                if not self.accept(')'):
+                    self.parse_value()
+                    while self.accept(','):
+                        self.parse_value()
+                    self.expect(')')
+                value = None
+            elif self.accept('['):
+                self.parse_value()
+                self.expect(']')
+                value = None
+            else:
+                return value
+    
+    def parse_primary(self):
+        kind, value, _ = self.next()
+        if kind == 'string':
+            value = value[1:-1]
+            return _JS_ESCAPE.sub(_js_unescape, value) if '\\' in value else value
+        if kind == 'number':
+            return float(value) if '.' in value or 'e' in value or 'E' in value else int(value)
+        if kind == 'name':
+            return _JS_CONSTANTS.get(value)
+        if value == '{':
+            return self.parse_object()
+        if value == '[':
+            return self.parse_array()
+        if value == '(':
+            value = self.parse_value()
+            self.expect(')')
+            return value
+        if value == '-':
+            value = self.parse_primary()
+            return -value if isinstance(value, (int, float)) else None
+        if value == '!':
+            value = self.parse_primary()
+            return not value
+        raise ValueError(f'Unexpected {value!r} before position {self.pos}')
+    
+    def parse_object(self):
+        result = {}
+        while not self.accept('}'):
+            kind, key, _ = self.next()
+            if kind == 'string':
+                key = key[1:-1]
+            elif kind not in ('name', 'number'):
+                raise ValueError(f'Unexpected object key {key!r} before position {self.pos}')
+            self.expect(':')
+            result[key] = self.parse_value()
+            if not self.accept(','):
+                self.expect('}')
+                break
+        return result
+    
+    def parse_array(self):
+        result = []
+        while not self.accept(']'):
+            result.append(self.parse_value())
+            if not self.accept(','):
+                self.expect(']')
+                break
+        return result
+
+
+def parse_js_object(text, pos=0):
+    """Parses the JS object literal starting at text[pos], returns (value, end position)"""
+    parser = _JSObjectParser(text, pos)
+    value = parser.parse_value()
+    return value, parser.pos
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Runs many (brand, category, mode) jobs in one process.
+The jobs share one MongoClient, the HTTP session of every brand, the translation cache,
+the image store and the worker pools instead of paying for a cold start each.
+At most scheduler_job_count jobs run at once, requests to every host stay under its host limit.
+
+Usage (from the repository root):
+    python scheduler.py <mode> [brand[:category]] [...]
+    mode - 0 parser, 1 update
+    a brand without category runs every category of the brand, no brands runs every brand
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import chain, zip_longest
+import sys
+import traceback
+
+from pymongo import MongoClient
+import toml
+
+from hm_parser import hm_parser
+from cos_parser import cos_parser
+
+
+CONFIG = toml.load(f'CONFIG.toml')
+JOB_COUNT = CONFIG['ParserManager'].get('scheduler_job_count', 1)
+
+BRANDS = {
+    'hm': hm_parser,
+    'cos': cos_parser,
+}
+
+
+def getJobs(mode, selected):
+    """
+    Builds (brand, category, mode) jobs. Update mode refreshes the whole brand, so it gets one job per brand.
+    Brands are interleaved so that jobs running at the same time hit different hosts.
+    """
+    jobsByBrand = {}
+    for item in selected or BRANDS:
+        brand, _, category = item.partition(':')
+        if mode == 1:
+            categories = [None]
+        elif category:
+            categories = [category]
+        else:
+            categories = list(BRANDS[brand].loadConfigFile('categories.json'))
+
+        jobs = jobsByBrand.setdefault(brand, [])
+        jobs.extend((brand, category, mode) for category in categories if (brand, category, mode) not in jobs)
+
+    return [job for job in chain.from_iterable(zip_longest(*jobsByBrand.values())) if job is not None]
+
+
+def run(jobs):
+    """
+    :jobs - list of (brand, category, mode) tuples, mode as in the parsers' main (0 parser, 1 update)
+    """
+    dbClient = MongoClient(host=CONFIG['Server']['host'],port=CONFIG['Server']['port'],username='admin',password=CONFIG['Server']['db_password'])
+
+    failed = []
+    try:
+        with ThreadPoolExecutor(max_workers=JOB_COUNT) as executor:
+            futures = {executor.submit(BRANDS[brand].main, mode, category, dbClient): (brand, category, mode)
+                       for brand, category, mode in jobs}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    traceback.print_exc()
+                    print("Job failed:", futures[future])
+                    failed.append(futures[future])
+    finally:
+        dbClient.close()
+
+    print("Jobs done:", len(jobs) - len(failed), "failed:", len(failed))
+    return failed
+
+
+if __name__ == '__main__':
+    try:
+        mode = int(sys.argv[1])
+        selected = sys.argv[2:]
+    except (IndexError, ValueError):
+        mode = None
+
+    if mode not in (0, 1) or any(item.partition(':')[0] not in BRANDS for item in selected):
+        print(f"Usage: {sys.argv[0]} <mode> [brand[:category]] [...]\n"
+              f"    mode - 0 parser, 1 update; brands: {', '.join(BRANDS)}")
+        sys.exit()
+
+    run(getJobs(mode, selected))